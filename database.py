@@ -1,18 +1,414 @@
+import json
 import sqlite3
-from typing import Optional, List, Dict, Any
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional, List, Dict, Any, Tuple, Iterator, Callable
 import datetime
+from pathlib import Path
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен - без него кодируем стандартным json
+    orjson = None
+
+
+# Текст запросов на запись один и тот же - sqlite3 берет подготовленный statement из кэша
+# Время пишем явно как Unix epoch - таблицы из старых версий имеют DEFAULT CURRENT_TIMESTAMP (текст)
+_INSERT_RATING_SQL = """
+    INSERT INTO ratings (user_id, movie_id, rating, timestamp) 
+    VALUES (?, ?, ?, CAST(strftime('%s', 'now') AS INTEGER)) 
+    ON CONFLICT(user_id, movie_id) DO UPDATE SET rating = excluded.rating
+"""
+
+_INSERT_HISTORY_SQL = """
+    INSERT INTO history (user_id, movie_id, action_type, timestamp) 
+    VALUES (?, ?, ?, CAST(strftime('%s', 'now') AS INTEGER))
+"""
+
+_INSERT_HISTORY_BY_TMDB_ID_SQL = """
+    INSERT INTO history (user_id, movie_id, action_type, timestamp) 
+    SELECT ?, id, ?, CAST(strftime('%s', 'now') AS INTEGER) FROM movies WHERE tmdb_id = ?
+"""
+
+_INSERT_USER_SQL = "INSERT OR IGNORE INTO users (id, username) VALUES (?, ?)"
+_DELETE_USER_PREFERENCES_SQL = "DELETE FROM preferences WHERE user_id = ?"
+_DELETE_USER_HISTORY_SQL = "DELETE FROM history WHERE user_id = ?"
+_UPSERT_TMDB_CACHE_SQL = """
+    INSERT OR REPLACE INTO tmdb_cache (key, body, etag, fetched_at) 
+    VALUES (?, ?, ?, ?)
+"""
+_TOUCH_TMDB_CACHE_SQL = "UPDATE tmdb_cache SET fetched_at = ? WHERE key = ?"
+_DELETE_OLD_TMDB_CACHE_SQL = "DELETE FROM tmdb_cache WHERE fetched_at < ?"
+
+_INSERT_PREFERENCE_SQL = """
+    INSERT INTO preferences (user_id, preference_type, preference_value) 
+    VALUES (?, ?, ?)
+"""
+
+# Уже сохраненный фильм обновляем свежими данными TMDB, а не пропускаем (INSERT OR IGNORE их терял);
+# пустые значения из нового ответа старые данные не затирают
+_UPSERT_MOVIE_SQL = """
+    INSERT INTO movies 
+    (tmdb_id, title, original_title, overview, release_date, vote_average, poster_path, genres, directors, actors, runtime)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(tmdb_id) DO UPDATE SET
+        title = COALESCE(excluded.title, title),
+        original_title = COALESCE(excluded.original_title, original_title),
+        overview = COALESCE(NULLIF(excluded.overview, ''), overview),
+        release_date = COALESCE(NULLIF(excluded.release_date, ''), release_date),
+        vote_average = COALESCE(excluded.vote_average, vote_average),
+        poster_path = COALESCE(NULLIF(excluded.poster_path, ''), poster_path),
+        genres = CASE WHEN excluded.genres = '[]' THEN genres ELSE excluded.genres END,
+        directors = CASE WHEN excluded.directors = '[]' THEN directors ELSE excluded.directors END,
+        actors = CASE WHEN excluded.actors = '[]' THEN actors ELSE excluded.actors END,
+        runtime = COALESCE(excluded.runtime, runtime)
+"""
+
+# Частые чтения - тоже константы: один и тот же объект строки на каждый вызов
+_SELECT_USER_SQL = "SELECT * FROM users WHERE id = ?"
+_SELECT_USER_PREFERENCES_SQL = "SELECT preference_type, preference_value FROM preferences WHERE user_id = ?"
+_SELECT_USER_HISTORY_SQL = "SELECT * FROM history WHERE user_id = ? ORDER BY timestamp DESC"
+_SELECT_USER_HISTORY_TUPLES_SQL = "SELECT movie_id, action_type, timestamp FROM history WHERE user_id = ? ORDER BY timestamp DESC"
+# Планировщик сам считает по индексу idx_history_user_ts, не заходя в саму таблицу
+# (без INDEXED BY: подсказка превратила бы переименование индекса в ошибку запроса)
+_COUNT_USER_HISTORY_SQL = "SELECT COUNT(*) FROM history WHERE user_id = ?"
+_SELECT_MOVIE_SQL = "SELECT * FROM movies WHERE id = ?"
+# Краткие данные фильма для списков и истории - без overview, актеров и режиссеров
+_MOVIE_SUMMARY_COLUMNS = "id, tmdb_id, title, poster_path, genres, vote_average"
+_SELECT_MOVIE_BY_TMDB_ID_SQL = "SELECT * FROM movies WHERE tmdb_id = ?"
+_SELECT_MOVIE_BY_TITLE_SQL = "SELECT * FROM movies WHERE title = ? OR original_title = ? LIMIT 1"
+_SELECT_TMDB_CACHE_SQL = "SELECT body, etag, fetched_at FROM tmdb_cache WHERE key = ?"
+
+# Версия схемы в PRAGMA user_version: увеличивать при каждом изменении скрипта в _create_schema
+_SCHEMA_VERSION = 5
+
+# Сколько фильмов держать в памяти (_MovieCache)
+_MOVIE_CACHE_SIZE = 4096
+
+# Сколько id передавать в один запрос IN (...)
+_IN_CHUNK_SIZE = 500
+
+# Кэш чтений по user_id (пользователь, предпочтения): повторные нажатия кнопок не ходят в базу.
+# Записи этого процесса сбрасывают кэш сразу, так что TTL ограничивает только гонку с параллельным чтением
+_USER_CACHE_SIZE = 10000
+_USER_CACHE_TTL = 30.0
+
+# Сколько хранить ответы TMDB: ключи включают текст поисковых запросов, так что без удаления таблица
+# растет бесконечно. Неделя - с запасом к суточному TTL, устаревшая запись еще нужна для проверки по ETag
+_TMDB_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+
+# Размер кэша подготовленных выражений на соединение (по умолчанию 128) - с запасом на все запросы модуля
+_CACHED_STATEMENTS = 256
+
+# Одиночная вставка сразу возвращает id - и новой строки, и обновленной существующей
+_UPSERT_MOVIE_RETURNING_ID_SQL = _UPSERT_MOVIE_SQL + "    RETURNING id\n"
+
+_SELECT_USER_RATINGS_SQL = """
+    SELECT r.movie_id, r.rating, m.title
+    FROM ratings r LEFT JOIN movies m ON m.id = r.movie_id
+    WHERE r.user_id = ?
+    ORDER BY r.timestamp DESC
+"""
+
+
+# json.dumps с нестандартными параметрами создает новый JSONEncoder на каждый вызов - держим один готовый
+_json_encode = json.JSONEncoder(ensure_ascii=False).encode
+
+
+def _encode_list(value: List[Any]) -> str:
+    """Кодирует список в JSON-текст: через orjson, если он установлен, иначе готовым JSONEncoder."""
+    if orjson is not None:
+        # orjson отдает UTF-8 bytes - в колонку пишем str, иначе SQLite сохранит BLOB
+        return orjson.dumps(value).decode()
+    return _json_encode(value)
+
+
+def _movie_params(movie: Dict[str, Any]) -> Tuple:
+    """Параметры для _UPSERT_MOVIE_SQL из словаря с данными фильма."""
+    return (
+        movie.get('tmdb_id'),
+        movie.get('title'),
+        movie.get('original_title'),
+        movie.get('overview'),
+        movie.get('release_date'),
+        movie.get('vote_average'),
+        movie.get('poster_path'),
+        # Списки храним JSON-массивом: без потерь на запятых в именах и без split при чтении
+        _encode_list(movie.get('genres', [])),
+        _encode_list(movie.get('directors', [])),
+        _encode_list(movie.get('actors', [])),
+        movie.get('runtime')
+    )
+
+
+def _parse_list(value: Optional[str]) -> List[str]:
+    """Разбирает список из колонки: JSON-массив или строка через запятую (записи старых версий)."""
+    if not value:
+        return []
+    if value.startswith('['):
+        try:
+            return [str(item) for item in (orjson.loads(value) if orjson is not None else json.loads(value))]
+        except ValueError:  # orjson.JSONDecodeError - тоже подкласс ValueError
+            pass
+    return [item.strip() for item in value.split(',')]
+
+
+def _row_to_movie(row: Optional[sqlite3.Row]) -> Optional[Dict[str, Any]]:
+    """Строка movies -> словарь фильма со списками genres/directors/actors, как у данных TMDB.
+
+    Разбираются только выбранные запросом колонки (краткая выборка их части не содержит).
+    """
+    if row is None:
+        return None
+    movie = dict(row)
+    for key in ('genres', 'directors', 'actors'):
+        if key in movie:
+            movie[key] = _parse_list(movie[key])
+    return movie
+
+
+def _copy_movie(movie: Dict[str, Any]) -> Dict[str, Any]:
+    """Копия словаря фильма со своими списками - изменения у вызывающего не портят кэш."""
+    movie = dict(movie)
+    for key in ('genres', 'directors', 'actors'):
+        if key in movie:
+            movie[key] = list(movie[key])
+    return movie
+
+
+class _MovieCache:
+    """LRU-кэш фильмов по tmdb_id (плюс соответствие id -> tmdb_id).
+
+    Строка movies меняется только при повторной загрузке фильма из TMDB - тогда запись сбрасывается
+    через invalidate(). version не дает положить в кэш строку, прочитанную до сброса.
+    """
+
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        self._movies: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._tmdb_ids: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def get(self, tmdb_id: Optional[int]) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            movie = self._movies.get(tmdb_id)
+            if movie is None:
+                return None
+            self._movies.move_to_end(tmdb_id)
+        return _copy_movie(movie)
+
+    def get_by_id(self, movie_id: int) -> Optional[Dict[str, Any]]:
+        return self.get(self._tmdb_ids.get(movie_id))
+
+    def put(self, movie: Optional[Dict[str, Any]], version: int):
+        if movie is None or movie.get('tmdb_id') is None:
+            return
+        with self._lock:
+            if version != self.version:
+                return
+            tmdb_id = movie['tmdb_id']
+            self._movies[tmdb_id] = _copy_movie(movie)
+            self._movies.move_to_end(tmdb_id)
+            self._tmdb_ids[movie['id']] = tmdb_id
+            if len(self._movies) > self._maxsize:
+                evicted = self._movies.popitem(last=False)[1]
+                self._tmdb_ids.pop(evicted['id'], None)
+
+    def invalidate(self, tmdb_ids: List[Optional[int]]):
+        with self._lock:
+            self.version += 1
+            for tmdb_id in tmdb_ids:
+                movie = self._movies.pop(tmdb_id, None)
+                if movie is not None:
+                    self._tmdb_ids.pop(movie['id'], None)
+
+
+# Отличает "в кэше нет" от закэшированного None (пользователь не найден)
+_MISSING = object()
+
+
+class _TTLCache:
+    """Кэш с временем жизни записей и ограничением размера (вытесняются самые старые).
+
+    Как и в _MovieCache, version не дает положить в кэш значение, прочитанное до сброса через pop().
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._items: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def get(self, key: Any) -> Any:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return _MISSING
+            if item[0] < time.monotonic():
+                del self._items[key]
+                return _MISSING
+            return item[1]
+
+    def put(self, key: Any, value: Any, version: int):
+        with self._lock:
+            if version != self.version:
+                return
+            self._items[key] = (time.monotonic() + self._ttl, value)
+            self._items.move_to_end(key)
+            if len(self._items) > self._maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key: Any):
+        with self._lock:
+            self.version += 1
+            self._items.pop(key, None)
 
 
 class MovieDatabase:
     def __init__(self, db_path: str):
-        self.conn = sqlite3.connect(db_path, check_same_thread=False)
-        self.conn.row_factory = sqlite3.Row
+        self.db_path = db_path
+        # Одно общее соединение на запись (SQLite все равно допускает одного писателя)
+        # и по долгоживущему соединению только для чтения на каждый поток
+        self._writer: Optional[sqlite3.Connection] = None
+        self._tls = threading.local()
+        self._readers: List[sqlite3.Connection] = []
+        self._write_lock = threading.RLock()
+        self._movie_cache = _MovieCache(_MOVIE_CACHE_SIZE)
+        self._user_cache = _TTLCache(_USER_CACHE_SIZE, _USER_CACHE_TTL)
+        self._preferences_cache = _TTLCache(_USER_CACHE_SIZE, _USER_CACHE_TTL)
+        self._enable_wal()
         self._ensure_tables()
+        self.optimize()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Соединение для записи, общее для всех потоков; используется только под _write_lock."""
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = sqlite3.connect(
+                    self.db_path, check_same_thread=False, cached_statements=_CACHED_STATEMENTS)
+                self._writer.row_factory = sqlite3.Row
+                self._configure_connection(self._writer)
+            return self._writer
+
+    @property
+    def _reader(self) -> sqlite3.Connection:
+        """Соединение текущего потока только для чтения (открывается при первом обращении)."""
+        conn = getattr(self._tls, "reader", None)
+        if conn is None:
+            # check_same_thread=False только ради close() из другого потока
+            uri = Path(self.db_path).absolute().as_uri() + "?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=_CACHED_STATEMENTS)
+            conn.row_factory = sqlite3.Row
+            self._configure_connection(conn)
+            self._tls.reader = conn
+            with self._write_lock:
+                self._readers.append(conn)
+        return conn
+
+    def _configure_connection(self, conn: sqlite3.Connection):
+        """Настройки соединения: облегченный fsync, кэш страниц 64 МБ и чтение через mmap."""
+        # Занятую другим процессом базу ждем до 5 с вместо немедленного "database is locked"
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-65536")
+        # mmap отображает только существующий размер файла - лимит 1 ГБ не резервирует память заранее
+        conn.execute("PRAGMA mmap_size=1073741824")
+
+    def _enable_wal(self):
+        """Переводит файл базы в WAL один раз: режим сохраняется в самом файле.
+
+        WAL позволяет читать параллельно с записью; писатель по-прежнему один (см. _write_lock).
+        """
+        mode = self.conn.execute("PRAGMA journal_mode").fetchone()[0]
+        if mode != "wal":
+            self.conn.execute("PRAGMA journal_mode=WAL")
+
+    def optimize(self):
+        """Удаляет старые ответы TMDB и обновляет статистику планировщика (sqlite_stat1), где она устарела."""
+        with self._write():
+            self.conn.execute(_DELETE_OLD_TMDB_CACHE_SQL, (time.time() - _TMDB_CACHE_MAX_AGE,))
+        with self._write_lock:
+            self.conn.execute("PRAGMA optimize")
+
+    def close(self):
+        # Закрываем соединения всех потоков; потоки, обратившиеся к базе позже, откроют новые
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.execute("PRAGMA optimize")
+            for conn in self._readers:
+                conn.close()
+            self._readers.clear()
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        self._tls = threading.local()
+
+    @contextmanager
+    def transaction(self):
+        """Объединяет несколько записей в одну транзакцию (один коммит на всю пачку).
+
+        Методы записи внутри блока не коммитят сами; вложенный transaction() входит во внешнюю.
+        """
+        with self._write_lock:
+            if getattr(self._tls, "in_transaction", False):
+                yield self.conn
+                return
+            self.conn.execute("BEGIN IMMEDIATE")
+            self._tls.in_transaction = True
+            self._tls.after_commit = []
+            try:
+                yield self.conn
+            except Exception:
+                self.conn.rollback()
+                raise
+            else:
+                self.conn.commit()
+            finally:
+                self._tls.in_transaction = False
+                # Кэши сбрасываем после коммита: иначе другой поток успел бы закэшировать старые данные
+                for invalidate in self._tls.after_commit:
+                    invalidate()
+
+    @contextmanager
+    def _write(self):
+        """Одиночная запись: `with conn` коммитит при успехе и откатывает при ошибке.
+
+        Внутри transaction() `with conn` не используется - он закоммитил бы внешнюю транзакцию раньше времени.
+        """
+        with self._write_lock:
+            if getattr(self._tls, "in_transaction", False):
+                yield self.conn
+                return
+            with self.conn:
+                yield self.conn
 
     def _ensure_tables(self):
-        """Создает таблицы, если они еще не существуют."""
-        cursor = self.conn.cursor()
-        cursor.executescript("""
+        """Создает таблицы, если они еще не существуют.
+
+        Схема уже актуальна, если PRAGMA user_version не меньше _SCHEMA_VERSION - тогда скрипт не выполняется.
+        """
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] >= _SCHEMA_VERSION:
+            return
+        with self._write_lock:
+            try:
+                self._create_schema()
+            except sqlite3.Error:
+                # Скрипт мог оборваться внутри BEGIN - не оставляем транзакцию открытой
+                if self.conn.in_transaction:
+                    self.conn.rollback()
+                raise
+
+    def _create_schema(self):
+        """Выполняет скрипт схемы одной транзакцией и записывает номер версии."""
+        self.conn.executescript("""
+        BEGIN IMMEDIATE;
+
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY,
             username TEXT,
@@ -45,7 +441,7 @@ class MovieDatabase:
             user_id INTEGER,
             movie_id INTEGER,
             rating INTEGER,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            timestamp INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
             FOREIGN KEY (user_id) REFERENCES users(id),
             FOREIGN KEY (movie_id) REFERENCES movies(id)
         );
@@ -54,91 +450,232 @@ class MovieDatabase:
             user_id INTEGER,
             movie_id INTEGER,
             action_type TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            timestamp INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
             FOREIGN KEY (user_id) REFERENCES users(id),
             FOREIGN KEY (movie_id) REFERENCES movies(id)
         );
+
+        -- Отдельные таблицы жанров никто не читал (жанры берутся из movies.genres) - удаляем
+        DROP TABLE IF EXISTS movie_genres;
+        DROP TABLE IF EXISTS genres;
+
+        -- Кэш ответов TMDB: ключ - путь запроса и параметры без api_key
+        CREATE TABLE IF NOT EXISTS tmdb_cache (
+            key TEXT PRIMARY KEY,
+            body TEXT,
+            etag TEXT,
+            fetched_at REAL
+        );
+
+        -- Оценки пользователя читаются по user_id в порядке убывания времени
+        CREATE INDEX IF NOT EXISTS idx_ratings_user_ts ON ratings(user_id, timestamp DESC);
+        -- Нужен для ON CONFLICT(user_id, movie_id) при повторной оценке
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_ratings_user_movie ON ratings(user_id, movie_id);
+        -- История: выборка по user_id с сортировкой по времени и COUNT(*) только по индексу;
+        -- movie_id и action_type в индексе - экран истории читается без обращения к таблице.
+        -- Скрипт выполняется только при смене версии, так что пересоздание индекса - разовая миграция
+        DROP INDEX IF EXISTS idx_history_user_ts;
+        CREATE INDEX idx_history_user_ts ON history(user_id, timestamp DESC, movie_id, action_type);
+        -- Предпочтения читаются и удаляются по user_id
+        CREATE INDEX IF NOT EXISTS idx_preferences_user ON preferences(user_id);
+
+        -- Время храним как Unix epoch (INTEGER): старые строки с текстовым CURRENT_TIMESTAMP переводим
+        UPDATE ratings SET timestamp = CAST(strftime('%s', timestamp) AS INTEGER) WHERE typeof(timestamp) = 'text';
+        UPDATE history SET timestamp = CAST(strftime('%s', timestamp) AS INTEGER) WHERE typeof(timestamp) = 'text';
+        """ + f"""
+        PRAGMA user_version = {_SCHEMA_VERSION};
+        COMMIT;
         """)
-        self.conn.commit()
 
     def get_user(self, user_id: int) -> Optional[sqlite3.Row]:
-        cur = self.conn.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-        return cur.fetchone()
+        user = self._user_cache.get(user_id)
+        if user is _MISSING:
+            version = self._user_cache.version
+            user = self._reader.execute(_SELECT_USER_SQL, (user_id,)).fetchone()
+            self._user_cache.put(user_id, user, version)
+        return user
 
     def add_user(self, user_id: int, username: str):
-        self.conn.execute("INSERT OR IGNORE INTO users (id, username) VALUES (?, ?)", (user_id, username))
-        self.conn.commit()
+        with self._write():
+            self.conn.execute(_INSERT_USER_SQL, (user_id, username))
+        self._after_write(lambda: self._user_cache.pop(user_id))
+
+    def get_user_preferences(self, user_id: int) -> List[sqlite3.Row]:
+        preferences = self._preferences_cache.get(user_id)
+        if preferences is _MISSING:
+            version = self._preferences_cache.version
+            preferences = self._reader.execute(_SELECT_USER_PREFERENCES_SQL, (user_id,)).fetchall()
+            self._preferences_cache.put(user_id, preferences, version)
+        # Копия списка - вызывающий может его менять (sqlite3.Row неизменяемы)
+        return list(preferences)
+
+    def _preferences_changed(self, user_id: int):
+        self._after_write(lambda: self._preferences_cache.pop(user_id))
 
-    def get_user_preferences(self, user_id: int) -> List[Dict[str, Any]]:
-        cur = self.conn.execute(
-            "SELECT preference_type, preference_value FROM preferences WHERE user_id = ?", (user_id,))
-        return [dict(row) for row in cur.fetchall()]
+    def add_user_preferences(self, user_id: int, preferences: List[Tuple[str, str]]):
+        """Сохраняет пачку предпочтений (preference_type, preference_value) одним executemany."""
+        if not preferences:
+            return
+        with self._write():
+            self.conn.executemany(_INSERT_PREFERENCE_SQL,
+                                  [(user_id, pref_type, pref_value) for pref_type, pref_value in preferences])
+        self._preferences_changed(user_id)
 
     def clear_user_preferences(self, user_id: int):
-        self.conn.execute("DELETE FROM preferences WHERE user_id = ?", (user_id,))
-        self.conn.commit()
+        with self._write():
+            self.conn.execute(_DELETE_USER_PREFERENCES_SQL, (user_id,))
+        self._preferences_changed(user_id)
 
     def clear_user_history(self, user_id: int):
-        self.conn.execute("DELETE FROM history WHERE user_id = ?", (user_id,))
-        self.conn.commit()
+        with self._write():
+            self.conn.execute(_DELETE_USER_HISTORY_SQL, (user_id,))
 
-    def get_user_history(self, user_id: int) -> List[Dict[str, Any]]:
-        cur = self.conn.execute(
-            "SELECT * FROM history WHERE user_id = ? ORDER BY timestamp DESC", (user_id,))
-        return [dict(row) for row in cur.fetchall()]
+    def clear_user_data(self, user_id: int):
+        """Очищает предпочтения и историю пользователя одной транзакцией."""
+        with self.transaction():
+            self.clear_user_preferences(user_id)
+            self.clear_user_history(user_id)
+
+    def get_user_history(self, user_id: int) -> List[sqlite3.Row]:
+        # Как и оценки, отдаем sqlite3.Row без копирования в dict
+        return self._reader.execute(_SELECT_USER_HISTORY_SQL, (user_id,)).fetchall()
+
+    def get_user_history_tuples(self, user_id: int) -> List[Tuple[int, str, int]]:
+        """История кортежами (movie_id, action_type, timestamp) - без обертки sqlite3.Row на каждую строку."""
+        cur = self._reader.cursor()
+        cur.row_factory = None
+        return cur.execute(_SELECT_USER_HISTORY_TUPLES_SQL, (user_id,)).fetchall()
 
     def get_user_history_count(self, user_id: int) -> int:
-        cur = self.conn.execute("SELECT COUNT(*) as count FROM history WHERE user_id = ?", (user_id,))
-        return cur.fetchone()["count"]
+        return self._reader.execute(_COUNT_USER_HISTORY_SQL, (user_id,)).fetchone()[0]
+
+    def _after_write(self, invalidate: Callable[[], None]):
+        """Сбрасывает кэш после записи: сразу или, внутри transaction(), после ее коммита."""
+        if getattr(self._tls, "in_transaction", False):
+            self._tls.after_commit.append(invalidate)
+        else:
+            invalidate()
+
+    def _movies_changed(self, tmdb_ids: List[Optional[int]]):
+        """Сбрасывает кэш для перезаписанных фильмов."""
+        self._after_write(lambda: self._movie_cache.invalidate(tmdb_ids))
+
+    def _get_movie_by(self, from_cache, sql: str, key: int) -> Optional[Dict[str, Any]]:
+        """Фильм из кэша, а при промахе - одним запросом sql по ключу (id или tmdb_id)."""
+        movie = from_cache(key)
+        if movie is None:
+            version = self._movie_cache.version
+            movie = _row_to_movie(self._reader.execute(sql, (key,)).fetchone())
+            self._movie_cache.put(movie, version)
+        return movie
 
     def get_movie(self, movie_id: int) -> Optional[Dict[str, Any]]:
-        cur = self.conn.execute("SELECT * FROM movies WHERE id = ?", (movie_id,))
-        row = cur.fetchone()
-        return dict(row) if row else None
+        return self._get_movie_by(self._movie_cache.get_by_id, _SELECT_MOVIE_SQL, movie_id)
+
+    def get_movie_summaries(self, movie_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+        """Краткие данные фильмов по списку id (словарь id -> фильм).
+
+        Закэшированные фильмы берутся из кэша целиком, остальные - запросом IN только по
+        колонкам _MOVIE_SUMMARY_COLUMNS; в кэш такие неполные записи не кладутся.
+        """
+        movies = {}
+        missing = []
+        for movie_id in dict.fromkeys(movie_ids):
+            movie = self._movie_cache.get_by_id(movie_id)
+            if movie is None:
+                missing.append(movie_id)
+            else:
+                movies[movie_id] = movie
+        # Частями: число параметров в одном запросе ограничено (SQLITE_MAX_VARIABLE_NUMBER)
+        for start in range(0, len(missing), _IN_CHUNK_SIZE):
+            chunk = missing[start:start + _IN_CHUNK_SIZE]
+            sql = f"SELECT {_MOVIE_SUMMARY_COLUMNS} FROM movies WHERE id IN ({','.join('?' * len(chunk))})"
+            for row in self._reader.execute(sql, chunk):
+                movie = _row_to_movie(row)
+                movies[movie['id']] = movie
+        return movies
 
     def get_movie_by_tmdb_id(self, tmdb_id: int) -> Optional[Dict[str, Any]]:
-        cur = self.conn.execute("SELECT * FROM movies WHERE tmdb_id = ?", (tmdb_id,))
-        row = cur.fetchone()
-        return dict(row) if row else None
-
-    def add_movie(self, movie: Dict[str, Any]) -> Optional[int]:
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            INSERT OR IGNORE INTO movies 
-            (tmdb_id, title, original_title, overview, release_date, vote_average, poster_path, genres, directors, actors, runtime)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            movie.get('tmdb_id'),
-            movie.get('title'),
-            movie.get('original_title'),
-            movie.get('overview'),
-            movie.get('release_date'),
-            movie.get('vote_average'),
-            movie.get('poster_path'),
-            ', '.join(movie.get('genres', [])),
-            ', '.join(movie.get('directors', [])),
-            ', '.join(movie.get('actors', [])),
-            movie.get('runtime')
-        ))
-        self.conn.commit()
-        return cursor.lastrowid
+        return self._get_movie_by(self._movie_cache.get, _SELECT_MOVIE_BY_TMDB_ID_SQL, tmdb_id)
+
+    def get_movie_by_title(self, title: str) -> Optional[Dict[str, Any]]:
+        return _row_to_movie(self._reader.execute(_SELECT_MOVIE_BY_TITLE_SQL, (title, title)).fetchone())
+
+    def add_movie(self, movie: Dict[str, Any]) -> int:
+        """Сохраняет фильм и возвращает его id (в том числе если он уже был в базе)."""
+        with self._write():
+            movie_id = self.conn.execute(_UPSERT_MOVIE_RETURNING_ID_SQL, _movie_params(movie)).fetchone()[0]
+        self._movies_changed([movie.get('tmdb_id')])
+        return movie_id
+
+    def add_movies(self, movies: List[Dict[str, Any]]):
+        """Сохраняет пачку фильмов одной транзакцией (уже существующие обновляются)."""
+        if not movies:
+            return
+        with self.transaction():
+            self.conn.executemany(_UPSERT_MOVIE_SQL, [_movie_params(movie) for movie in movies])
+            self._movies_changed([movie.get('tmdb_id') for movie in movies])
 
     def add_user_history(self, user_id: int, movie_id: int, action_type: str):
-        self.conn.execute("""
-            INSERT INTO history (user_id, movie_id, action_type) 
-            VALUES (?, ?, ?)
-        """, (user_id, movie_id, action_type))
-        self.conn.commit()
+        with self._write():
+            self.conn.execute(_INSERT_HISTORY_SQL, (user_id, movie_id, action_type))
+
+    def add_user_history_many(self, entries: List[Tuple[int, int, str]]):
+        """Сохраняет пачку записей истории (user_id, movie_id, action_type) одной транзакцией."""
+        if not entries:
+            return
+        with self.transaction():
+            self.conn.executemany(_INSERT_HISTORY_SQL, entries)
+
+    def add_movies_to_history(self, user_id: int, movies: List[Dict[str, Any]], action_type: str):
+        """Записывает показанные пользователю фильмы в историю одной транзакцией.
+
+        Фильмы с tmdb_id уже сохранены движком рекомендаций (add_movies) - здесь добавляются
+        только строки истории, id фильма берется подзапросом по tmdb_id.
+        """
+        if not movies:
+            return
+        with self.transaction():
+            self.conn.executemany(_INSERT_HISTORY_BY_TMDB_ID_SQL,
+                                  [(user_id, action_type, movie['tmdb_id']) for movie in movies
+                                   if movie.get('tmdb_id') is not None])
+            # Без tmdb_id фильм не найти по ключу - сохраняем по одному и берем id из RETURNING
+            self.add_user_history_many([(user_id, self.add_movie(movie), action_type)
+                                        for movie in movies if movie.get('tmdb_id') is None])
 
-    def get_user_ratings(self, user_id: int) -> List[Dict[str, Any]]:
-        cur = self.conn.execute(
-            "SELECT movie_id, rating FROM ratings WHERE user_id = ? ORDER BY timestamp DESC", (user_id,))
-        return [dict(row) for row in cur.fetchall()]
+    def get_user_ratings(self, user_id: int) -> List[sqlite3.Row]:
+        # sqlite3.Row уже поддерживает доступ по имени колонки - не копируем в dict;
+        # название подтягиваем JOIN-ом, чтобы не ходить в movies за каждой оценкой
+        return self._reader.execute(_SELECT_USER_RATINGS_SQL, (user_id,)).fetchall()
+
+    def iter_user_ratings(self, user_id: int, batch_size: int = 100) -> Iterator[sqlite3.Row]:
+        """Отдает оценки пользователя порциями, не загружая всю выборку в память."""
+        cur = self._reader.execute(_SELECT_USER_RATINGS_SQL, (user_id,))
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
 
     def add_rating(self, user_id: int, movie_id: int, rating: int):
-        self.conn.execute("""
-            INSERT INTO ratings (user_id, movie_id, rating) 
-            VALUES (?, ?, ?) 
-            ON CONFLICT(user_id, movie_id) DO UPDATE SET rating = excluded.rating
-        """, (user_id, movie_id, rating))
-        self.conn.commit()
+        with self._write():
+            self.conn.execute(_INSERT_RATING_SQL, (user_id, movie_id, rating))
+
+    def add_feedback(self, feedback: List[Tuple[int, int, int]]):
+        """Сохраняет оценки (user_id, movie_id, rating) и записи о них в истории одной транзакцией."""
+        with self.transaction():
+            self.conn.executemany(_INSERT_RATING_SQL, feedback)
+            self.conn.executemany(_INSERT_HISTORY_SQL,
+                                  [(user_id, movie_id, f"rated_{rating}") for user_id, movie_id, rating in feedback])
+
+    def get_tmdb_cache(self, key: str) -> Optional[sqlite3.Row]:
+        return self._reader.execute(_SELECT_TMDB_CACHE_SQL, (key,)).fetchone()
+
+    def set_tmdb_cache(self, key: str, body: str, etag: Optional[str]):
+        with self._write():
+            self.conn.execute(_UPSERT_TMDB_CACHE_SQL, (key, body, etag, time.time()))
+
+    def touch_tmdb_cache(self, key: str):
+        """Продлевает срок жизни записи кэша (TMDB ответил 304 Not Modified)."""
+        with self._write():
+            self.conn.execute(_TOUCH_TMDB_CACHE_SQL, (time.time(), key))
@@ -1,11 +1,21 @@
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
 import sys
+import threading
+import time
 import asyncio
+import functools
 import re  # Add this import for regex
-from typing import Dict, Any, List
+from collections import defaultdict
+from operator import itemgetter
+from typing import Dict, Any, List, Optional
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -19,18 +29,75 @@ from telegram.ext import (
 from database import MovieDatabase
 from recommendation import RecommendationEngine
 
-# Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Configure logging: handlers put records into a queue, formatting and console output
+# happen in the QueueListener thread and do not block the event loop
+_log_queue = queue.SimpleQueue()
+_console_handler = logging.StreamHandler()
+_console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+# Записи копятся пачкой и выводятся разом: при заполнении буфера, на ERROR и раз в секунду
+_buffered_handler = logging.handlers.MemoryHandler(
+    capacity=256, flushLevel=logging.ERROR, target=_console_handler)
+_log_listener = logging.handlers.QueueListener(_log_queue, _buffered_handler, respect_handler_level=True)
+_queue_handler = logging.handlers.QueueHandler(_log_queue)
+# QueueHandler подставляет в запись готовый текст сообщения, оформление добавит _console_handler
+_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[_queue_handler])
+_log_listener.start()
+# atexit вызывает в обратном порядке: сначала остановка слушателя, затем сброс буфера
+atexit.register(_buffered_handler.close)
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
+# Интервал принудительного сброса буфера логов, секунды
+_LOG_FLUSH_INTERVAL = 1.0
+
+
+def _flush_logs_periodically() -> None:
+    """Flush buffered log records so INFO messages do not wait for a full buffer."""
+    while True:
+        time.sleep(_LOG_FLUSH_INTERVAL)
+        _buffered_handler.flush()
+
+
+threading.Thread(target=_flush_logs_periodically, name="log-flush", daemon=True).start()
+
 # Load environment variables
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 TMDB_API_KEY = os.getenv('TMDB_API_KEY')
+# Необязательно: адрес локального сервера Bot API (например, http://localhost:8081/bot)
+TELEGRAM_BASE_URL = os.getenv('TELEGRAM_BASE_URL')
+
+# Пул соединений к Bot API: запросы разных чатов переиспользуют keep-alive соединения, а не открывают новые
+_TELEGRAM_POOL_SIZE = 64
+
+# Экранируем только основные специальные символы Markdown для Telegram (и сам обратный слеш)
+# Точек и дефисов в списке нет, так как их обычно не нужно экранировать
+_MARKDOWN_ESCAPE_TABLE = str.maketrans({char: '\\' + char for char in '\\_*[]()~`>#+=|{}'})
+
+# Последовательности вида "\u1234", которые Telegram не принимает в Markdown
+_UNICODE_ESCAPE_RE = re.compile(r'\\u([0-9a-fA-F]{4})')
+
+# Кнопки оценки фильма: от 1 до 10
+_RATING_VALUES = tuple(range(1, 11))
+
+
+def _build_no_tmdb_id_markup() -> InlineKeyboardMarkup:
+    """Keyboard for a movie card without tmdb_id: ratings cannot be saved, so it never changes."""
+    rating_buttons = [InlineKeyboardButton(str(rating), callback_data=f"rate_none_{rating}")
+                      for rating in _RATING_VALUES]
+    return InlineKeyboardMarkup([
+        rating_buttons[:5],
+        rating_buttons[5:],
+        [InlineKeyboardButton("🔍 Похожие фильмы", callback_data="similar_None")],
+    ])
+
+
+_NO_TMDB_ID_MARKUP = _build_no_tmdb_id_markup()
+
+# (тип, значение) из строки предпочтений
+_PREFERENCE_FIELDS = itemgetter('preference_type', 'preference_value')
 
 # States for conversation
 RECOMMENDATION, RATING, FEEDBACK = range(3)
@@ -46,6 +113,12 @@ engine = RecommendationEngine(
 )
 
 
+
+async def db_call(fn, *args, **kwargs):
+    """Run a blocking MovieDatabase call in a worker thread so updates from other chats are not stalled."""
+    return await asyncio.to_thread(fn, *args, **kwargs)
+
+
 # Command handlers
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a welcome message when the command /start is issued."""
@@ -54,8 +127,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     username = user.username or user.first_name or "новый пользователь"
 
     # Add user to database if not exists
-    if not db.get_user(user_id):
-        db.add_user(user_id, username)
+    if not await db_call(db.get_user, user_id):
+        await db_call(db.add_user, user_id, username)
 
     welcome_message = (
         f"👋 Привет, {username}! Я твой персональный помощник по рекомендации фильмов.\n\n"
@@ -101,58 +174,55 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Display user profile when the command /profile is issued."""
     user_id = update.effective_user.id
-    user = db.get_user(user_id)
+    user = await db_call(db.get_user, user_id)
 
     if not user:
         await update.message.reply_text("Ваш профиль не найден. Используйте /start для начала.")
         return
 
-    # Get user preferences
-    preferences = db.get_user_preferences(user_id)
-
-    # Get user ratings
-    ratings = db.get_user_ratings(user_id)
+    # Get user preferences, ratings and history size in parallel
+    preferences, ratings, total_recommendations = await asyncio.gather(
+        db_call(db.get_user_preferences, user_id),
+        db_call(db.get_user_ratings, user_id),
+        db_call(db.get_user_history_count, user_id),
+    )
 
-    # Prepare profile message
-    profile_message = f"👤 *Ваш профиль*\n\n"
+    # Prepare profile message (части собираем в список и склеиваем один раз)
+    profile_parts = ["👤 *Ваш профиль*\n\n"]
 
     # Add preferences section
-    profile_message += "*Ваши предпочтения:*\n"
+    profile_parts.append("*Ваши предпочтения:*\n")
     if preferences:
         # Group preferences by type
-        pref_by_type = {}
-        for pref in preferences:
-            pref_type = pref['preference_type']
-            if pref_type not in pref_by_type:
-                pref_by_type[pref_type] = []
-            pref_by_type[pref_type].append(pref['preference_value'])
+        pref_by_type = defaultdict(list)
+        for pref_type, pref_value in map(_PREFERENCE_FIELDS, preferences):
+            pref_by_type[pref_type].append(pref_value)
 
         # Format each preference type
         for pref_type, values in pref_by_type.items():
             # Escape Markdown in preference values
-            escaped_values = [escape_markdown(val) for val in values[:5]]
-            profile_message += f"• {escape_markdown(pref_type.capitalize())}: {', '.join(escaped_values)}"
+            escaped_values = list(map(escape_markdown, values[:5]))
+            profile_parts.append(f"• {escape_markdown(pref_type.capitalize())}: {', '.join(escaped_values)}")
             if len(values) > 5:
-                profile_message += f" и еще {len(values) - 5}"
-            profile_message += "\n"
+                profile_parts.append(f" и еще {len(values) - 5}")
+            profile_parts.append("\n")
     else:
-        profile_message += "Пока нет сохраненных предпочтений.\n"
+        profile_parts.append("Пока нет сохраненных предпочтений.\n")
 
     # Add ratings section
-    profile_message += "\n*Ваши оценки фильмов:*\n"
+    profile_parts.append("\n*Ваши оценки фильмов:*\n")
     if ratings:
         for i, rating in enumerate(ratings[:5]):  # Show only 5 most recent ratings
-            movie = db.get_movie(rating['movie_id'])
-            if movie:
+            # Название уже пришло вместе с оценкой (JOIN movies)
+            if rating['title']:
                 # Escape movie title
-                escaped_title = escape_markdown(movie['title'])
-                profile_message += f"• {escaped_title} - {rating['rating']}/10\n"
+                escaped_title = escape_markdown(rating['title'])
+                profile_parts.append(f"• {escaped_title} - {rating['rating']}/10\n")
     else:
-        profile_message += "Пока нет оценок фильмов.\n"
+        profile_parts.append("Пока нет оценок фильмов.\n")
 
     # Add statistics
-    total_recommendations = db.get_user_history_count(user_id)
-    profile_message += f"\n📊 *Статистика:*\n• Получено рекомендаций: {total_recommendations}\n"
+    profile_parts.append(f"\n📊 *Статистика:*\n• Получено рекомендаций: {total_recommendations}\n")
 
     # Add button to clear preferences
     keyboard = [
@@ -160,7 +230,7 @@ async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await update.message.reply_text(profile_message, parse_mode='Markdown', reply_markup=reply_markup)
+    await update.message.reply_text(''.join(profile_parts), parse_mode='Markdown', reply_markup=reply_markup)
 
 
 async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -168,33 +238,32 @@ async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_id = update.effective_user.id
 
     # Get user history from database
-    history = db.get_user_history(user_id)
+    history = await db_call(db.get_user_history_tuples, user_id)
 
     if not history:
         await update.message.reply_text("У вас пока нет истории рекомендаций.")
         return
 
-    # Prepare history message
-    history_message = "📜 *Ваша история рекомендаций:*\n\n"
+    # Prepare history message (части собираем в список и склеиваем один раз)
+    history_parts = ["📜 *Ваша история рекомендаций:*\n\n"]
 
     # Group history by timestamp (date)
-    from datetime import datetime
-    from collections import defaultdict
+    from datetime import date
+
+    # Все фильмы истории - одним запросом, а не по запросу на каждую запись
+    movies = await db_call(db.get_movie_summaries, [movie_id for movie_id, _, _ in history])
 
     history_by_date = defaultdict(list)
-    for item in history:
-        timestamp = item['timestamp']
-        date = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
-        history_by_date[date].append(item)
+    for movie_id, action_type, timestamp in history:
+        # Ключ группы - сам объект date: без перевода в строку и обратного разбора
+        history_by_date[date.fromtimestamp(timestamp)].append((movie_id, action_type))
 
     # Format history items by date
-    for date, items in sorted(history_by_date.items(), reverse=True):
-        formatted_date = datetime.strptime(date, '%Y-%m-%d').strftime('%d %b %Y')
-        history_message += f"*{formatted_date}*\n"
+    for day, items in sorted(history_by_date.items(), reverse=True):
+        history_parts.append(f"*{day.strftime('%d %b %Y')}*\n")
 
-        for item in items:
-            action_type = item['action_type']
-            movie = db.get_movie(item['movie_id'])
+        for movie_id, action_type in items:
+            movie = movies.get(movie_id)
 
             if movie:
                 # Escape movie title for Markdown
@@ -202,11 +271,11 @@ async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
                 if action_type.startswith('rated_'):
                     rating = action_type.split('_')[1]
-                    history_message += f"• Оценили \"{escaped_title}\" на {rating}/10\n"
+                    history_parts.append(f"• Оценили \"{escaped_title}\" на {rating}/10\n")
                 else:
-                    history_message += f"• Получили рекомендацию \"{escaped_title}\"\n"
+                    history_parts.append(f"• Получили рекомендацию \"{escaped_title}\"\n")
 
-        history_message += "\n"
+        history_parts.append("\n")
 
     # Add button to clear history
     keyboard = [
@@ -214,7 +283,7 @@ async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await update.message.reply_text(history_message, parse_mode='Markdown', reply_markup=reply_markup)
+    await update.message.reply_text(''.join(history_parts), parse_mode='Markdown', reply_markup=reply_markup)
 
 
 async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -243,9 +312,9 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     user_query = update.message.text
 
     # Check if user exists, if not add them
-    if not db.get_user(user_id):
+    if not await db_call(db.get_user, user_id):
         username = update.effective_user.username or update.effective_user.first_name or "новый пользователь"
-        db.add_user(user_id, username)
+        await db_call(db.add_user, user_id, username)
 
     # Send typing action
     await update.message.chat.send_action(action="typing")
@@ -288,18 +357,10 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         context.user_data['recommendations'] = recommendations
 
         # Send detailed cards for each recommended movie
-        for movie in recommendations:
-            await send_movie_card(update, context, movie)
+        await send_movie_cards(update, context, recommendations)
 
         # Store recommendations in user history
-        for movie in recommendations:
-            tmdb_id = movie.get('tmdb_id')
-            # Check if movie exists in db
-            existing_movie = db.get_movie_by_tmdb_id(tmdb_id)
-            movie_id = existing_movie['id'] if existing_movie else db.add_movie(movie)
-            # Add to history
-            if movie_id:
-                db.add_user_history(user_id, movie_id, 'recommended')
+        await _record_history(user_id, recommendations, 'recommended')
 
         return RECOMMENDATION
 
@@ -312,27 +373,101 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         return ConversationHandler.END
 
 
+def _unicode_escape_repl(match: re.Match) -> str:
+    return f"U+{match.group(1).upper()}"
+
+
+# Названия, жанры и имена повторяются от карточки к карточке - экранированный результат кэшируем
+@functools.lru_cache(maxsize=4096)
 def escape_markdown(text: str) -> str:
     """Escape Markdown special characters to prevent formatting issues in Telegram messages."""
     if not text:
         return ""
 
-    # Сначала экранируем обратные слеши
-    text = text.replace('\\', '\\\\')
-
-    # Экранируем только основные специальные символы Markdown для Telegram
-    # Убираем точки и дефисы из списка, так как они обычно не нужно экранировать
-    special_chars = r'_*[]()~`>#+=|{}'
-    for char in special_chars:
-        text = text.replace(char, f'\\{char}')
+    # Экранируем обратные слеши и спецсимволы за один проход
+    text = text.translate(_MARKDOWN_ESCAPE_TABLE)
 
     # Удаляем любые оставшиеся проблемные последовательности Unicode
-    # Заменяем последовательности вида "\u1234" на их текстовое представление
-    text = re.sub(r'\\u([0-9a-fA-F]{4})', lambda m: f"U+{m.group(1).upper()}", text)
+    # Заменяем последовательности вида "\u1234" на их текстовое представление (без слеша их быть не может)
+    if '\\' in text:
+        text = _UNICODE_ESCAPE_RE.sub(_unicode_escape_repl, text)
 
     return text
 
 
+
+class AsyncTokenBucket:
+    """Token bucket for outgoing messages: `rate` messages per second on average, bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: int):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        # Ожидающие получают токены по очереди, в порядке прихода
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Wait until a token is available (and any pause requested by Telegram is over), then take it."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+    def pause(self, seconds: float) -> None:
+        """Stop handing out tokens for `seconds` (Telegram answered 429 with retry_after)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+# Общий лимит исходящих сообщений бота - чуть ниже 30 в секунду, чтобы не получать 429
+_SEND_BUCKET = AsyncTokenBucket(rate=28, capacity=30)
+
+
+# Сколько раз повторять отправку после 429, прежде чем сдаться
+_SEND_RETRY_ATTEMPTS = 3
+
+
+async def _send_limited(send, **kwargs):
+    """Call a Bot send method under the global rate limit, retrying after 429.
+
+    The pause requested by Telegram is applied to the shared bucket, so it holds back sends to
+    every chat, not only this one. If the limit is still hit after _SEND_RETRY_ATTEMPTS retries,
+    RetryAfter is re-raised.
+    """
+    for attempt in range(_SEND_RETRY_ATTEMPTS + 1):
+        await _SEND_BUCKET.acquire()
+        try:
+            return await send(**kwargs)
+        except RetryAfter as e:
+            if attempt == _SEND_RETRY_ATTEMPTS:
+                raise
+            # retry_after - секунды (int) или timedelta, в зависимости от версии python-telegram-bot
+            retry_after = e.retry_after
+            _SEND_BUCKET.pause(retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else retry_after)
+
+
+async def send_movie_cards(update: Update, context: ContextTypes.DEFAULT_TYPE, movies: List[Dict[str, Any]]) -> None:
+    """Send cards for several movies one after another; a failed card is logged and does not stop the others.
+
+    Cards go out in list order so the chat keeps the order of the recommendations
+    (each card is a poster plus a separate description message).
+    """
+    for movie in movies:
+        try:
+            await send_movie_card(update, context, movie)
+        except Exception as e:
+            logger.error(f"Error sending movie card for {movie.get('title')}: {e}")
+
+
 async def send_movie_card(update: Update, context: ContextTypes.DEFAULT_TYPE, movie: Dict[str, Any]) -> None:
     """Send a card with movie details."""
     title = movie.get('title', 'Unknown Title')
@@ -362,6 +497,8 @@ async def send_movie_card(update: Update, context: ContextTypes.DEFAULT_TYPE, mo
     title_display = escape_markdown(clean_text(title_display))
     overview = escape_markdown(clean_text(movie.get('overview', 'Описание отсутствует.')))
     release_date = clean_text(movie.get('release_date', 'N/A'))
+    # Год вычисляем один раз для подписи к фото и полного сообщения
+    year_text = movie.get('year') or (release_date[:4] if release_date and len(release_date) >= 4 else 'Не указан')
     vote_average = movie.get('vote_average', 0)
 
     # Format genres and escape Markdown
@@ -395,7 +532,7 @@ async def send_movie_card(update: Update, context: ContextTypes.DEFAULT_TYPE, mo
     # Prepare basic info message - без описания для фото
     photo_caption = (
         f"🎬 *{title_display}*\n\n"
-        f"📅 *Год выпуска:* {release_date[:4] if release_date and len(release_date) >= 4 else 'Не указан'}\n"
+        f"📅 *Год выпуска:* {year_text}\n"
         f"⭐ *Рейтинг:* {vote_average}/10\n"
         f"⏱️ *Продолжительность:* {runtime_text}\n"
         f"🎭 *Жанр:* {genres_text}\n"
@@ -403,13 +540,9 @@ async def send_movie_card(update: Update, context: ContextTypes.DEFAULT_TYPE, mo
     )
 
     # Полное сообщение с описанием и актерами для текстового сообщения
+    # (начинается с той же шапки, что и подпись к фото - не форматируем ее второй раз)
     full_message = (
-        f"🎬 *{title_display}*\n\n"
-        f"📅 *Год выпуска:* {release_date[:4] if release_date and len(release_date) >= 4 else 'Не указан'}\n"
-        f"⭐ *Рейтинг:* {vote_average}/10\n"
-        f"⏱️ *Продолжительность:* {runtime_text}\n"
-        f"🎭 *Жанр:* {genres_text}\n"
-        f"🎬 *Режиссер:* {directors_text}\n"
+        f"{photo_caption}\n"
         f"👨‍👩‍👧‍👦 *В главных ролях:* {actors_text}\n\n"
         f"📝 *Описание:*\n{overview}"
     )
@@ -419,27 +552,20 @@ async def send_movie_card(update: Update, context: ContextTypes.DEFAULT_TYPE, mo
     tmdb_link = f"https://www.themoviedb.org/movie/{tmdb_id}" if tmdb_id else None
 
     # Create keyboard with rating buttons and TMDB link
-    keyboard = []
-
-    # Add rating buttons
-    rating_buttons = []
-    for rating in range(1, 11):
-        # Add movie_id to callback data
-        callback_data = f"rate_{tmdb_id}_{rating}" if tmdb_id else f"rate_none_{rating}"
-        rating_buttons.append(InlineKeyboardButton(str(rating), callback_data=callback_data))
-
-    # Split rating buttons into 2 rows
-    keyboard.append(rating_buttons[:5])
-    keyboard.append(rating_buttons[5:])
-
-    # Add TMDB link and similar movies buttons
-    bottom_buttons = []
-    if tmdb_link:
-        bottom_buttons.append(InlineKeyboardButton("🔗 TMDB", url=tmdb_link))
-    bottom_buttons.append(InlineKeyboardButton("🔍 Похожие фильмы", callback_data=f"similar_{tmdb_id}"))
-    keyboard.append(bottom_buttons)
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    if tmdb_id:
+        rating_buttons = [InlineKeyboardButton(str(rating), callback_data=f"rate_{tmdb_id}_{rating}")
+                          for rating in _RATING_VALUES]
+        reply_markup = InlineKeyboardMarkup([
+            # Split rating buttons into 2 rows
+            rating_buttons[:5],
+            rating_buttons[5:],
+            # Add TMDB link and similar movies buttons
+            [InlineKeyboardButton("🔗 TMDB", url=tmdb_link),
+             InlineKeyboardButton("🔍 Похожие фильмы", callback_data=f"similar_{tmdb_id}")],
+        ])
+    else:
+        # Без tmdb_id клавиатура всегда одна и та же
+        reply_markup = _NO_TMDB_ID_MARKUP
 
     # Get poster URL
     poster_path = movie.get('poster_path')
@@ -449,7 +575,8 @@ async def send_movie_card(update: Update, context: ContextTypes.DEFAULT_TYPE, mo
     if poster_url:
         try:
             # Отправляем фото только с базовой информацией (без описания и актеров)
-            await context.bot.send_photo(
+            await _send_limited(
+                context.bot.send_photo,
                 chat_id=chat_id,
                 photo=poster_url,
                 caption=photo_caption,
@@ -458,22 +585,28 @@ async def send_movie_card(update: Update, context: ContextTypes.DEFAULT_TYPE, mo
             )
 
             # Отправляем отдельным сообщением информацию об актерах и описание
-            await context.bot.send_message(
+            await _send_limited(
+                context.bot.send_message,
                 chat_id=chat_id,
                 text=f"👨‍👩‍👧‍👦 *В главных ролях:* {actors_text}\n\n📝 *Описание фильма \"{title_display}\":*\n\n{overview}",
                 parse_mode='Markdown'
             )
+        except RetryAfter:
+            # Лимит так и не отпустил - запасной текст получил бы тот же 429, карточку пропускаем
+            raise
         except Exception as e:
             logger.error(f"Error sending movie poster: {e}")
             # Fallback to text-only message
-            await context.bot.send_message(
+            await _send_limited(
+                context.bot.send_message,
                 chat_id=chat_id,
                 text=full_message,
                 parse_mode='Markdown',
                 reply_markup=reply_markup
             )
     else:
-        await context.bot.send_message(
+        await _send_limited(
+            context.bot.send_message,
             chat_id=chat_id,
             text=full_message,
             parse_mode='Markdown',
@@ -481,169 +614,286 @@ async def send_movie_card(update: Update, context: ContextTypes.DEFAULT_TYPE, mo
         )
 
 
-async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Handle button presses from inline keyboards."""
-    query = update.callback_query
-    await query.answer()
-
+async def _on_rate_button(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user_id: int) -> int:
+    """Handle rating buttons (rate_<tmdb_id>_<rating>)."""
     callback_data = query.data
-    user_id = update.effective_user.id
-
-    # Handle rating buttons
-    if callback_data.startswith('rate_'):
-        # Extract movie_id and rating
-        parts = callback_data.split('_')
-        tmdb_id = int(parts[1]) if parts[1] != 'none' else None
-        rating = int(parts[2])
+    # Extract movie_id and rating
+    parts = callback_data.split('_')
+    tmdb_id = int(parts[1]) if parts[1] != 'none' else None
+    rating = int(parts[2])
+
+    if not tmdb_id:
+        await query.edit_message_reply_markup(reply_markup=None)
+        await query.message.reply_text(
+            f"⚠️ Извините, не удалось сохранить оценку. ID фильма не найден."
+        )
+        return RECOMMENDATION
 
-        if not tmdb_id:
-            await query.edit_message_reply_markup(reply_markup=None)
-            await query.message.reply_text(
-                f"⚠️ Извините, не удалось сохранить оценку. ID фильма не найден."
-            )
-            return RECOMMENDATION
+    # Get movie from database
+    movie = await db_call(db.get_movie_by_tmdb_id, tmdb_id)
+    if not movie:
+        await query.edit_message_reply_markup(reply_markup=None)
+        await query.message.reply_text(
+            f"⚠️ Извините, не удалось сохранить оценку. Фильм не найден в базе данных."
+        )
+        return RECOMMENDATION
 
-        # Get movie from database
-        movie = db.get_movie_by_tmdb_id(tmdb_id)
-        if not movie:
-            await query.edit_message_reply_markup(reply_markup=None)
-            await query.message.reply_text(
-                f"⚠️ Извините, не удалось сохранить оценку. Фильм не найден в базе данных."
-            )
-            return RECOMMENDATION
+    # Process rating
+    success = await engine.process_user_feedback(user_id, tmdb_id, rating)
 
-        # Process rating
-        success = await engine.process_user_feedback(user_id, tmdb_id, rating)
+    if success:
+        # Remove rating buttons from the original message
+        await query.edit_message_reply_markup(reply_markup=None)
 
-        if success:
-            # Remove rating buttons from the original message
-            await query.edit_message_reply_markup(reply_markup=None)
+        # Escape movie title for Markdown
+        escaped_title = escape_markdown(movie['title'])
 
-            # Escape movie title for Markdown
-            escaped_title = escape_markdown(movie['title'])
+        # Send confirmation message
+        await query.message.reply_text(
+            f"✅ Спасибо за оценку! Вы поставили фильму \"{escaped_title}\" оценку {rating}/10."
+        )
 
-            # Send confirmation message
-            await query.message.reply_text(
-                f"✅ Спасибо за оценку! Вы поставили фильму \"{escaped_title}\" оценку {rating}/10."
+        # Provide some feedback based on the rating
+        if rating >= 8:
+            feedback_message = (
+                "Отлично! Я учту, что вам очень понравился этот фильм "
+                f"и буду рекомендовать похожие в будущем."
+            )
+        elif rating >= 6:
+            feedback_message = (
+                "Хорошо! Я учту ваше положительное мнение о фильме для будущих рекомендаций."
+            )
+        elif rating >= 4:
+            feedback_message = (
+                "Понятно. Я учту ваше нейтральное отношение к этому фильму."
             )
-
-            # Provide some feedback based on the rating
-            if rating >= 8:
-                feedback_message = (
-                    "Отлично! Я учту, что вам очень понравился этот фильм "
-                    f"и буду рекомендовать похожие в будущем."
-                )
-            elif rating >= 6:
-                feedback_message = (
-                    "Хорошо! Я учту ваше положительное мнение о фильме для будущих рекомендаций."
-                )
-            elif rating >= 4:
-                feedback_message = (
-                    "Понятно. Я учту ваше нейтральное отношение к этому фильму."
-                )
-            else:
-                feedback_message = (
-                    "Я учту, что вам не понравился этот фильм, и постараюсь избегать похожих рекомендаций."
-                )
-
-            await query.message.reply_text(feedback_message)
         else:
-            await query.message.reply_text(
-                "⚠️ Извините, произошла ошибка при сохранении вашей оценки. Пожалуйста, попробуйте позже."
+            feedback_message = (
+                "Я учту, что вам не понравился этот фильм, и постараюсь избегать похожих рекомендаций."
             )
 
+        await query.message.reply_text(feedback_message)
+    else:
+        await query.message.reply_text(
+            "⚠️ Извините, произошла ошибка при сохранении вашей оценки. Пожалуйста, попробуйте позже."
+        )
+
+    return RECOMMENDATION
+
+
+async def _on_similar_button(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user_id: int) -> int:
+    """Handle similar movies button (similar_<tmdb_id>)."""
+    callback_data = query.data
+    tmdb_id = int(callback_data.split('_')[1])
+
+    # Get movie from database
+    movie = await db_call(db.get_movie_by_tmdb_id, tmdb_id)
+    if not movie:
+        await query.message.reply_text(
+            "⚠️ Извините, не удалось найти похожие фильмы. Фильм не найден в базе данных."
+        )
         return RECOMMENDATION
 
-    # Handle similar movies button
-    elif callback_data.startswith('similar_'):
-        tmdb_id = int(callback_data.split('_')[1])
+    # Escape movie title for Markdown
+    escaped_title = escape_markdown(movie['title'])
 
-        # Get movie from database
-        movie = db.get_movie_by_tmdb_id(tmdb_id)
-        if not movie:
+    # Let user know we're working on it
+    processing_message = await query.message.reply_text(
+        f"🔍 Ищу фильмы, похожие на \"{escaped_title}\"..."
+    )
+
+    try:
+        # Get similar movies
+        similar_movies = await engine.get_similar_movies(movie['title'], user_id)
+
+        # Delete processing message safely
+        try:
+            await processing_message.delete()
+        except Exception as delete_error:
+            logger.warning(f"Could not delete processing message: {delete_error}")
+
+        if not similar_movies:
             await query.message.reply_text(
-                "⚠️ Извините, не удалось найти похожие фильмы. Фильм не найден в базе данных."
+                f"😕 Извините, не удалось найти фильмы, похожие на \"{escaped_title}\"."
             )
             return RECOMMENDATION
 
-        # Escape movie title for Markdown
-        escaped_title = escape_markdown(movie['title'])
-
-        # Let user know we're working on it
-        processing_message = await query.message.reply_text(
-            f"🔍 Ищу фильмы, похожие на \"{escaped_title}\"..."
+        # Send message with similar movies
+        await query.message.reply_text(
+            f"🎬 Вот фильмы, похожие на \"{escaped_title}\":",
+            parse_mode='Markdown'
         )
 
+        # Send movie cards for similar movies
+        similar_movies = similar_movies[:5]  # Limit to 5
+        await send_movie_cards(update, context, similar_movies)
+
+        # Store recommendations in history
+        await _record_history(user_id, similar_movies, 'similar')
+
+    except Exception as e:
+        logger.error(f"Error finding similar movies: {e}")
+        # Delete processing message safely
         try:
-            # Get similar movies
-            similar_movies = await engine.get_similar_movies(movie['title'], user_id)
+            await processing_message.delete()
+        except Exception as delete_error:
+            logger.warning(f"Could not delete processing message: {delete_error}")
+        await query.message.reply_text(
+            f"😟 Извините, произошла ошибка при поиске похожих фильмов: {str(e)}"
+        )
 
-            # Delete processing message safely
-            try:
-                await processing_message.delete()
-            except Exception as delete_error:
-                logger.warning(f"Could not delete processing message: {delete_error}")
+    return RECOMMENDATION
 
-            if not similar_movies:
-                await query.message.reply_text(
-                    f"😕 Извините, не удалось найти фильмы, похожие на \"{escaped_title}\"."
-                )
-                return RECOMMENDATION
 
-            # Send message with similar movies
-            await query.message.reply_text(
-                f"🎬 Вот фильмы, похожие на \"{escaped_title}\":",
-                parse_mode='Markdown'
-            )
+async def _on_clear_preferences_button(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user_id: int) -> int:
+    """Handle preference clearing."""
+    await db_call(db.clear_user_preferences, user_id)
+    await query.message.reply_text("✅ Ваши предпочтения успешно очищены.")
+    return ConversationHandler.END
 
-            # Send movie cards for similar movies
-            for similar_movie in similar_movies[:5]:  # Limit to 5
-                await send_movie_card(update, context, similar_movie)
 
-                # Store recommendation in history
-                existing_movie = db.get_movie_by_tmdb_id(similar_movie.get('tmdb_id'))
-                movie_id = existing_movie['id'] if existing_movie else db.add_movie(similar_movie)
-                if movie_id:
-                    db.add_user_history(user_id, movie_id, 'similar')
+async def _on_clear_history_button(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user_id: int) -> int:
+    """Handle history clearing."""
+    await db_call(db.clear_user_history, user_id)
+    await query.message.reply_text("✅ Ваша история рекомендаций успешно очищена.")
+    return ConversationHandler.END
 
-        except Exception as e:
-            logger.error(f"Error finding similar movies: {e}")
-            # Delete processing message safely
-            try:
-                await processing_message.delete()
-            except Exception as delete_error:
-                logger.warning(f"Could not delete processing message: {delete_error}")
-            await query.message.reply_text(
-                f"😟 Извините, произошла ошибка при поиске похожих фильмов: {str(e)}"
-            )
 
+async def _on_confirm_clear_all_button(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user_id: int) -> int:
+    """Handle confirmation for clearing all."""
+    await db_call(db.clear_user_data, user_id)
+    await query.message.reply_text("✅ Все ваши предпочтения и история успешно очищены.")
+    return ConversationHandler.END
+
+
+async def _on_cancel_clear_button(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user_id: int) -> int:
+    """Handle cancellation for clearing all."""
+    await query.message.reply_text("❌ Операция отменена. Ваши данные остались без изменений.")
+    return ConversationHandler.END
+
+
+# Обработчики кнопок: точное значение callback_data или префикс до первого "_" (rate_..., similar_...)
+_BUTTON_HANDLERS = {
+    'rate': _on_rate_button,
+    'similar': _on_similar_button,
+    'clear_preferences': _on_clear_preferences_button,
+    'clear_history': _on_clear_history_button,
+    'confirm_clear_all': _on_confirm_clear_all_button,
+    'cancel_clear': _on_cancel_clear_button,
+}
+
+
+async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Handle button presses from inline keyboards."""
+    query = update.callback_query
+    await query.answer()
+
+    callback_data = query.data
+    user_id = update.effective_user.id
+
+    # Один поиск в словаре вместо цепочки startswith/== по всем кнопкам
+    handler = _BUTTON_HANDLERS.get(callback_data) or _BUTTON_HANDLERS.get(callback_data.split('_', 1)[0])
+    if handler is None:
         return RECOMMENDATION
+    return await handler(update, context, query, user_id)
 
-    # Handle preference clearing
-    elif callback_data == "clear_preferences":
-        db.clear_user_preferences(user_id)
-        await query.message.reply_text("✅ Ваши предпочтения успешно очищены.")
-        return ConversationHandler.END
 
-    # Handle history clearing
-    elif callback_data == "clear_history":
-        db.clear_user_history(user_id)
-        await query.message.reply_text("✅ Ваша история рекомендаций успешно очищена.")
-        return ConversationHandler.END
+# Как часто обслуживать базу (старые ответы TMDB, PRAGMA optimize), секунды
+_DB_OPTIMIZE_INTERVAL = 15 * 60
+_db_optimize_task: Optional[asyncio.Task] = None
 
-    # Handle confirmation for clearing all
-    elif callback_data == "confirm_clear_all":
-        db.clear_user_preferences(user_id)
-        db.clear_user_history(user_id)
-        await query.message.reply_text("✅ Все ваши предпочтения и история успешно очищены.")
-        return ConversationHandler.END
 
-    # Handle cancellation for clearing all
-    elif callback_data == "cancel_clear":
-        await query.message.reply_text("❌ Операция отменена. Ваши данные остались без изменений.")
-        return ConversationHandler.END
+async def _optimize_db_periodically() -> None:
+    """Prune old TMDB responses and keep SQLite planner statistics fresh, at startup and then periodically."""
+    while True:
+        try:
+            await asyncio.to_thread(db.optimize)
+        except Exception as e:
+            logger.warning(f"Database maintenance failed: {e}")
+        await asyncio.sleep(_DB_OPTIMIZE_INTERVAL)
 
-    return RECOMMENDATION
+
+# История показанных фильмов пишется в фоне пачками: ответ пользователю не ждет записи в базу,
+# а несколько записей, накопившихся за время одной транзакции, уходят следующим общим коммитом
+_HISTORY_BATCH_SIZE = 50
+_history_queue: Optional[asyncio.Queue] = None
+_history_writer_task: Optional[asyncio.Task] = None
+
+
+async def _record_history(user_id: int, movies: List[Dict[str, Any]], action_type: str) -> None:
+    """Queue shown movies for the history writer (written right away if the writer is not running)."""
+    if _history_queue is None:
+        await db_call(db.add_movies_to_history, user_id, movies, action_type)
+        return
+    _history_queue.put_nowait((user_id, movies, action_type))
+
+
+def _write_history_batch(batch: List[tuple]) -> None:
+    """Write queued history entries in a single transaction.
+
+    If the batch fails, the entries are retried one by one, so one bad entry does not
+    roll back the history of the other users in the batch.
+    """
+    try:
+        with db.transaction():
+            for user_id, movies, action_type in batch:
+                db.add_movies_to_history(user_id, movies, action_type)
+        return
+    except Exception as e:
+        logger.error(f"Error saving history batch, retrying entries one by one: {e}")
+    for user_id, movies, action_type in batch:
+        try:
+            db.add_movies_to_history(user_id, movies, action_type)
+        except Exception as e:
+            logger.error(f"Error saving history for user {user_id}: {e}")
+
+
+async def _write_history_in_background() -> None:
+    """Drain the history queue, writing whatever has accumulated as one batch."""
+    while True:
+        batch = [await _history_queue.get()]
+        while len(batch) < _HISTORY_BATCH_SIZE and not _history_queue.empty():
+            batch.append(_history_queue.get_nowait())
+        write = asyncio.ensure_future(asyncio.to_thread(_write_history_batch, batch))
+        try:
+            await asyncio.shield(write)
+        except asyncio.CancelledError:
+            # Пачка уже пишется в потоке - дожидаемся ее, иначе база закроется посреди записи
+            await asyncio.wait([write])
+            raise
+        except Exception as e:
+            logger.error(f"Error saving history: {e}")
+
+
+async def on_startup(application: Application) -> None:
+    """Start background maintenance tasks."""
+    global _db_optimize_task, _history_queue, _history_writer_task
+    _db_optimize_task = asyncio.create_task(_optimize_db_periodically())
+    _history_queue = asyncio.Queue()
+    _history_writer_task = asyncio.create_task(_write_history_in_background())
+
+
+async def on_shutdown(application: Application) -> None:
+    """Release shared resources when the bot stops."""
+    global _history_queue
+    if _db_optimize_task is not None:
+        _db_optimize_task.cancel()
+    if _history_writer_task is not None:
+        _history_writer_task.cancel()
+        # Забираем то, что осталось в очереди, и ждем, пока фоновая задача допишет свою пачку
+        pending = []
+        while not _history_queue.empty():
+            pending.append(_history_queue.get_nowait())
+        _history_queue = None
+        try:
+            await _history_writer_task
+        except asyncio.CancelledError:
+            pass
+        if pending:
+            await asyncio.to_thread(_write_history_batch, pending)
+    await engine.aclose()
+    # Соединения с базой живут все время работы бота и закрываются только здесь
+    db.close()
 
 
 def main() -> None:
@@ -662,7 +912,16 @@ def main() -> None:
         sys.exit(1)
 
     # Create the Application
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .request(HTTPXRequest(connection_pool_size=_TELEGRAM_POOL_SIZE, connect_timeout=5.0))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(TELEGRAM_BASE_URL)
+    application = builder.build()
 
     # Add conversation handler
     conv_handler = ConversationHandler(
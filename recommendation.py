@@ -2,24 +2,265 @@ import os
 import json
 import logging
 import google.generativeai as genai
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, AsyncIterator, Tuple, Set
 import requests
 import re
 from database import MovieDatabase
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен - без него разбираем стандартным json
+    orjson = None
 import asyncio
 import time
 import random
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlencode
 import httpx
 import ssl
+import hashlib
+import threading
+import functools
+from collections import OrderedDict
+from dataclasses import dataclass, field
 
-# Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Logging is configured by the application (main.py)
 logger = logging.getLogger(__name__)
 
+# Сколько ответов LLM держать в памяти (LRU)
+_LLM_CACHE_SIZE = 256
+
+# Данные о фильмах в TMDB меняются редко - кэшируем ответы на сутки
+_TMDB_CACHE_TTL = 24 * 60 * 60
+
+# Кэш обогащенных данными TMDB запросов пользователей
+_ENRICH_CACHE_SIZE = 1024
+_ENRICH_CACHE_TTL = 60 * 60
+
+# Максимальная пауза между повторными попытками, секунды
+_MAX_RETRY_DELAY = 16.0
+
+# Ошибки клиента, которые имеет смысл повторять
+_RETRIABLE_4XX = (408, 429)
+
+# Сколько запросов к TMDB одного пользовательского запроса выполнять одновременно
+_TMDB_MAX_CONCURRENCY = 5
+
+# Строка лога оценки кандидата из поиска TMDB (пишется для каждого результата)
+_MOVIE_SCORE_LOG_FMT = "Movie: '%s' (%s) - Score: %s"
+
+# Пул соединений общего HTTP-клиента: запас под несколько одновременных пользователей
+# с _TMDB_MAX_CONCURRENCY запросами каждый плюс параллельное обогащение запроса
+_HTTP_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=16, keepalive_expiry=60.0)
+_HTTP_TIMEOUT = httpx.Timeout(30.0, connect=10.0)
+
+# Сколько фильмов проверять одним запросом к LLM
+_VALIDATION_BATCH_SIZE = 8
+
+_JSON_ARRAY_RE = re.compile(r'\[.*\]', re.DOTALL)
+_NUMBERED_ANSWER_RE = re.compile(r'^\s*\d+[.)]\s*(ДА|НЕТ|YES|NO)', re.IGNORECASE | re.MULTILINE)
+
+# Регулярные выражения компилируем один раз при импорте модуля
+
+# Названия фильмов с годом в ответе LLM - все варианты оформления в одном выражении,
+# чтобы проходить по тексту один раз
+_TITLE_WITH_YEAR_RE = re.compile(
+    r'\*\*"(?P<a>[^"]+)"\s*\((?P<ya>\d{4})\)\*\*'  # **"Title" (Year)**
+    r'|"(?P<b>[^"]+)"\s*\((?P<yb>\d{4})\)'         # "Title" (Year)
+    r'|\*\*(?P<c>[^*]+)\*\*\s*\((?P<yc>\d{4})\)'  # **Title** (Year)
+    r'|«(?P<d>[^»]+)»\s*\((?P<yd>\d{4})\)'         # «Title» (Year) - русские кавычки
+)
+
+# Названия без года - в кавычках/звездочках
+_TITLE_SIMPLE_RE = re.compile(
+    r'\*\*"(?P<a>[^"]+)"\*\*'  # **"Title"**
+    r'|"(?P<b>[^"]+)"'         # "Title"
+    r'|\*\*(?P<c>[^*]+)\*\*'   # **Title**
+    r'|«(?P<d>[^»]+)»'         # «Title»
+)
+
+_NON_TITLE_WORDS = frozenset(('год', 'фильм', 'года', 'this', 'that'))
+
+_QUOTED_RE = re.compile(r'"([^"]+)"')
+# Год в названии вместе с пробелами перед ним: одно совпадение дает и год, и границы для вырезания
+_TITLE_YEAR_RE = re.compile(r'\s*\((\d{4})\)')
+
+# Базовая нормализация русских имен и фамилий
+_PERSON_NAME_MAPPING = {
+    # Популярные актеры (из косвенных падежей в именительный)
+    'томом хэнксом': 'Том Хэнкс',
+    'тома хэнкса': 'Том Хэнкс',
+    'стивена спилберга': 'Стивен Спилберг',
+    'стивеном спилбергом': 'Стивен Спилберг',
+    'роберта дауни': 'Роберт Дауни',
+    'робертом дауни': 'Роберт Дауни',
+    'кристофера нолана': 'Кристофер Нолан',
+    'кристофером ноланом': 'Кристофер Нолан',
+    'леонардо дикаприо': 'Леонардо ДиКаприо',
+    'леонардом дикаприо': 'Леонардо ДиКаприо',
+    'брэда питта': 'Брэд Питт',
+    'брэдом питтом': 'Брэд Питт',
+    'джонни деппа': 'Джонни Депп',
+    'джонни деппом': 'Джонни Депп',
+    'уилла смита': 'Уилл Смит',
+    'уиллом смитом': 'Уилл Смит',
+    'квентина тарантино': 'Квентин Тарантино',
+    'квентином тарантино': 'Квентин Тарантино',
+    'мартина скорсезе': 'Мартин Скорсезе',
+    'мартином скорсезе': 'Мартин Скорсезе',
+    'скарлетт йоханссон': 'Скарлетт Йоханссон',
+    'скарлетт йоханссон': 'Скарлетт Йоханссон',
+    'анджелины джоли': 'Анджелина Джоли',
+    'анджелиной джоли': 'Анджелина Джоли',
+}
+
+def _union_pattern(patterns: Tuple[str, ...]) -> 're.Pattern':
+    """Объединяет шаблоны с одной группой захвата в одно выражение - запрос сканируется один раз."""
+    return re.compile('|'.join(f'(?:{pattern})' for pattern in patterns))
+
+
+def _union_findall(regex: 're.Pattern', text: str) -> List[str]:
+    """Возвращает захваченную группу каждого совпадения объединенного выражения."""
+    return [match.group(match.lastindex) for match in regex.finditer(text)]
+
+
+# Актеры, упомянутые в запросе пользователя
+_ACTOR_RE = _union_pattern((
+    r'с\s+([А-ЯЁ][а-яё]+[ыоауеймх]?\s+[А-ЯЁ][а-яё]+[ыоауеймх]?)',
+    r'актер[а-я]*\s+([А-ЯЁ][а-яё]+[ауы]?\s+[А-ЯЁ][а-яё]+[ауы]?)',
+    r'участие[мн]\s+([А-ЯЁ][а-яё]+[ауы]?\s+[А-ЯЁ][а-яё]+[ауы]?)',
+))
+
+# Режиссеры, упомянутые в запросе пользователя
+_DIRECTOR_RE = _union_pattern((
+    r'от\s+(?:режиссера\s+)?([А-ЯЁ][а-яё]+[ауы]?\s+[А-ЯЁ][а-яё]+[ауы]?)',
+    r'режиссер[а-я]*\s+([А-ЯЁ][а-яё]+[ауы]?\s+[А-ЯЁ][а-яё]+[ауы]?)',
+))
+
+# Упоминания конкретных фильмов в запросе
+_MOVIE_MENTION_RE = _union_pattern((
+    r'"([^"]+)"',  # фильмы в кавычках
+    r'как\s+([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)*)',  # "как Интерстеллар", "как Джон Уик"
+    r'типа\s+([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)*)',  # "типа Матрицы", "типа Джон Уик"  
+    r'похож[а-я]*\s+на\s+([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)*)',  # "похожие на Джон Уик"
+))
+
+# Упоминания актеров/режиссеров для обогащения запроса
+_PERSON_MENTION_RE = _union_pattern((
+    r'с\s+([А-ЯЁ][а-яё]+[ыоауеймх]?\s+[А-ЯЁ][а-яё]+[ыоауеймх]?)',  # "с Томом Хэнксом" 
+    r'от\s+(?:режиссера\s+)?([А-ЯЁ][а-яё]+[ауы]?\s+[А-ЯЁ][а-яё]+[ауы]?)',  # "от Стивена Спилберга"
+    r'актер[а-я]*\s+([А-ЯЁ][а-яё]+[ауы]?\s+[А-ЯЁ][а-яё]+[ауы]?)',  # "актера Роберта Дауни"
+    r'режиссер[а-я]*\s+([А-ЯЁ][а-яё]+[ауы]?\s+[А-ЯЁ][а-яё]+[ауы]?)',  # "режиссера Кристофера Нолана"
+))
+
+
+def _json_loads(data):
+    """Разбирает JSON через orjson, если он установлен (в разы быстрее на ответах TMDB)."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _backoff_delay(base_delay: float, attempt: int) -> float:
+    """Экспоненциальная пауза с ограничением сверху и случайным разбросом (jitter)."""
+    return min(base_delay * (2 ** attempt), _MAX_RETRY_DELAY) + random.uniform(0, 0.25 * base_delay)
+
+
+def _release_year(release_date: Optional[str]) -> str:
+    """Год из даты выпуска TMDB ('YYYY-MM-DD') или пустая строка, если даты нет."""
+    year = release_date[:4] if release_date else ''
+    return year if year.isdigit() else ''
+
+
+@functools.lru_cache(maxsize=4096)
+def _name_parts(name: str) -> Optional[Tuple[str, str]]:
+    """Имя и фамилия из полного имени; имена актеров повторяются между фильмами, поэтому кэшируем."""
+    parts = name.split()
+    if len(parts) < 2:
+        return None
+    return parts[0], parts[-1]
+
+
+def _is_rate_limited(error: BaseException) -> bool:
+    """Превышение квоты Gemini (429) - единственная ошибка LLM, которую имеет смысл повторять."""
+    return "429" in str(error)
+
+
+async def _retry(coro_factory, retries: int, base_delay: float, should_retry=_is_rate_limited):
+    """
+    Выполняет корутину с повторами и экспоненциальной паузой с jitter.
+
+    Ошибки, для которых should_retry возвращает False (ключ, безопасность, ValueError и т.п.),
+    пробрасываются сразу, без ожидания.
+    """
+    for attempt in range(retries):
+        try:
+            return await coro_factory()
+        except Exception as e:
+            if attempt >= retries - 1 or not should_retry(e):
+                raise
+            wait_time = _backoff_delay(base_delay, attempt)
+            logger.warning(f"Retriable LLM error, retrying in {wait_time:.1f} seconds... ({attempt + 1}/{retries}): {e}")
+            await asyncio.sleep(wait_time)
+
+# Ключевые слова для определения жанров в запросе пользователя
+_GENRE_KEYWORDS = {
+    'боевик': ['боевик', 'боевики', 'экшн', 'action'],
+    'комедия': ['комедия', 'комедии', 'comedy'],
+    'драма': ['драма', 'драмы', 'drama'],
+    'ужасы': ['ужасы', 'ужас', 'хоррор', 'horror'],
+    'фантастика': ['фантастика', 'фантастику', 'sci-fi', 'научная фантастика'],
+    'триллер': ['триллер', 'триллеры', 'thriller'],
+    'мелодрама': ['мелодрама', 'мелодрамы', 'романтика', 'романтику', 'romance'],
+    'детектив': ['детектив', 'детективы', 'mystery'],
+    'анимация': ['анимация', 'анимационный', 'мультфильм', 'мультфильмы', 'animation'],
+    'документальный': ['документальный', 'документальные', 'documentary']
+}
+_GENRE_BY_KEYWORD = {keyword: genre for genre, keywords in _GENRE_KEYWORDS.items() for keyword in keywords}
+# Все ключевые слова в одной альтернации; длинные идут первыми, чтобы "мелодрама" не читалась как "драма"
+_GENRE_KEYWORD_RE = re.compile('|'.join(
+    re.escape(keyword) for keyword in sorted(_GENRE_BY_KEYWORD, key=len, reverse=True)))
+
+# Таблицы для резервной (без ИИ) проверки соответствия жанров
+_FALLBACK_GENRE_KEYWORDS = {
+    'боевик': ('боевик', 'экшн', 'action'),
+    'комедия': ('комедия', 'comedy'),
+    'драма': ('драма', 'drama'),
+    'ужасы': ('ужасы', 'хоррор', 'horror'),
+    'фантастика': ('фантастика', 'sci-fi', 'научная фантастика'),
+    'триллер': ('триллер', 'thriller'),
+    'мелодрама': ('мелодрама', 'романтика', 'romance'),
+    'детектив': ('детектив', 'mystery'),
+    'анимация': ('анимация', 'мультфильм', 'animation'),
+    'документальный': ('документальный', 'documentary')
+}
+_COMEDY_ROMANCE_GENRES = frozenset({'мелодрама', 'комедия', 'романтический', 'романтика'})
+_ACTION_GENRES = frozenset({'боевик', 'экшн', 'триллер', 'криминал', 'приключения'})
+_NON_ACTION_GENRES = frozenset({'мелодрама', 'комедия', 'документальный'})
+_INCOMPATIBLE_GENRES = (
+    ('боевик', frozenset({'мелодрама', 'комедия', 'документальный'})),
+    ('ужасы', frozenset({'комедия', 'мелодрама', 'детский'})),
+    ('комедия', frozenset({'ужасы', 'триллер', 'драма'})),
+    ('детск', frozenset({'ужасы', 'триллер', 'взрослый'}))
+)
+
+
+@dataclass(slots=True)
+class MovieSummary:
+    """Краткие данные о фильме из списков TMDB (фильмография, популярное по жанру)."""
+    tmdb_id: Optional[int]
+    title: str
+    original_title: str
+    release_date: str
+    vote_average: float
+    overview: str = ''
+    character: str = ''
+    job: str = ''
+    # Год выпуска считаем один раз при создании, а не при каждом форматировании
+    year: str = field(default='', init=False)
+
+    def __post_init__(self):
+        self.year = _release_year(self.release_date)
+
 
 class RecommendationEngine:
     def __init__(self, api_key: str, tmdb_api_key: str, db: MovieDatabase):
@@ -36,6 +277,18 @@ class RecommendationEngine:
         self.db = db
         self.tmdb_base_url = "https://api.themoviedb.org/3"
 
+        # Shared HTTP client for TMDB requests (created lazily, reused across calls)
+        self._http_client: Optional[httpx.AsyncClient] = None
+        # Выполняющиеся запросы к TMDB по ключу кэша (склейка одинаковых запросов)
+        self._tmdb_inflight: Dict[str, asyncio.Future] = {}
+
+        # LRU-кэш ответов LLM: одинаковые промпты не отправляем повторно
+        self._llm_cache: "OrderedDict[str, str]" = OrderedDict()
+
+        # LRU-кэш обогащенных запросов с TTL: (время, текст) по исходному запросу
+        self._enrich_cache: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._enrich_inflight: Dict[str, asyncio.Future] = {}
+
         # Configure Google Generative AI
         genai.configure(api_key=api_key)
 
@@ -44,7 +297,19 @@ class RecommendationEngine:
         self.proxies = []
         self.current_proxy = None
 
-        # Get available models and select appropriate model
+        # Список моделей запрашиваем в фоновом потоке: старт бота не ждет сетевого запроса к Gemini
+        self._model = None
+        self._model_selection = threading.Thread(target=self._select_model, name="gemini-model-select", daemon=True)
+        self._model_selection.start()
+
+    async def _get_model(self):
+        """Gemini model; if the background selection is still running, wait for it without blocking the loop."""
+        if self._model is None:
+            await asyncio.to_thread(self._model_selection.join)
+        return self._model
+
+    def _select_model(self) -> None:
+        """Get available models and select appropriate model."""
         try:
             # Преобразуем генератор в список
             self.models = list(genai.list_models())
@@ -95,15 +360,202 @@ class RecommendationEngine:
                         selected_model = "gemini-1.5-flash"
                         logger.warning(f"No suitable models found, defaulting to: {selected_model}")
 
-            self.model = genai.GenerativeModel(selected_model)
+            self._model = genai.GenerativeModel(selected_model)
             logger.info(f"Successfully initialized model: {selected_model}")
 
         except Exception as e:
             logger.error(f"Error selecting model: {str(e)}")
             # Fallback to a lightweight model
-            self.model = genai.GenerativeModel("gemini-1.5-flash")
+            self._model = genai.GenerativeModel("gemini-1.5-flash")
             logger.info("Using default model: gemini-1.5-flash due to error")
 
+    def _get_http_client(self) -> httpx.AsyncClient:
+        """Return the shared HTTP client for TMDB, creating it on first use."""
+        if self._http_client is None or self._http_client.is_closed:
+            # HTTP/2 мультиплексирует параллельные запросы к TMDB в одном TLS-соединении
+            self._http_client = httpx.AsyncClient(
+                timeout=_HTTP_TIMEOUT, limits=_HTTP_LIMITS, verify=True, http2=True)
+        return self._http_client
+
+    async def aclose(self):
+        """Close the shared HTTP client."""
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
+
+    async def _tmdb_get(self, path: str, params: Dict[str, Any], max_retries: int = 3) -> Dict[str, Any]:
+        """
+        Perform a GET request to the TMDB API over the shared HTTP client.
+
+        Args:
+            path: API path relative to the TMDB base URL, e.g. "/search/movie"
+            params: Query parameters (the API key is added automatically)
+            max_retries: Number of attempts on network errors and retriable HTTP statuses
+
+        Returns:
+            Parsed JSON response
+        """
+        cache_key = f"{path}?{urlencode(sorted(params.items()))}"
+        cached = await self._db(self.db.get_tmdb_cache, cache_key)
+        if cached and time.time() - cached['fetched_at'] < _TMDB_CACHE_TTL:
+            return _json_loads(cached['body'])
+
+        # Такой же запрос уже выполняется - ждем его результат вместо нового обращения к TMDB
+        task = self._tmdb_inflight.get(cache_key)
+        if task is None:
+            task = asyncio.ensure_future(self._tmdb_fetch(path, params, cache_key, cached, max_retries))
+            self._tmdb_inflight[cache_key] = task
+            task.add_done_callback(lambda _: self._tmdb_inflight.pop(cache_key, None))
+        # shield: отмена одного из ожидающих не должна отменять запрос для остальных
+        return await asyncio.shield(task)
+
+    async def _tmdb_fetch(self, path: str, params: Dict[str, Any], cache_key: str,
+                          cached: Optional[Any], max_retries: int) -> Dict[str, Any]:
+        """
+        Fetch a TMDB response over the network and store it in the cache.
+
+        Args:
+            path: API path relative to the TMDB base URL
+            params: Query parameters without the API key
+            cache_key: Key of the response in the TMDB cache
+            cached: Stale cache entry used for ETag revalidation, if any
+            max_retries: Number of attempts on network errors and retriable HTTP statuses
+
+        Returns:
+            Parsed JSON response
+        """
+        # Устаревшую запись проверяем по ETag, чтобы не скачивать тот же ответ заново
+        headers = {"If-None-Match": cached['etag']} if cached and cached['etag'] else None
+
+        url = f"{self.tmdb_base_url}{path}"
+        params = {"api_key": self.tmdb_api_key, **params}
+        client = self._get_http_client()
+
+        for attempt in range(max_retries):
+            try:
+                response = await client.get(url, params=params, headers=headers)
+                if response.status_code == 304 and cached:
+                    await self._db(self.db.touch_tmdb_cache, cache_key)
+                    return _json_loads(cached['body'])
+                response.raise_for_status()
+                data = _json_loads(response.content)
+                await self._db(self.db.set_tmdb_cache, cache_key, response.text, response.headers.get('etag'))
+                return data
+            except (httpx.ConnectError, httpx.ReadError, httpx.ConnectTimeout,
+                    httpx.ReadTimeout, httpx.HTTPStatusError, ssl.SSLError) as e:
+                # 4xx (кроме 408/429) повторять бесполезно - только тратим квоту TMDB
+                if isinstance(e, httpx.HTTPStatusError):
+                    status_code = e.response.status_code
+                    if 400 <= status_code < 500 and status_code not in _RETRIABLE_4XX:
+                        raise
+                if attempt < max_retries - 1:
+                    wait_time = _backoff_delay(2, attempt)
+                    logger.warning(f"TMDB request {path} attempt {attempt+1} failed: {e}. Retrying in {wait_time:.1f}s...")
+                    await asyncio.sleep(wait_time)
+                else:
+                    logger.error(f"All TMDB request attempts failed for {path}: {e}")
+                    raise
+
+    async def _db(self, fn, *args, **kwargs):
+        """
+        Run a blocking MovieDatabase call in a worker thread so SQLite never stalls the event loop.
+
+        MovieDatabase keeps one connection per thread and serializes writes itself,
+        so no extra locking is needed here.
+
+        Args:
+            fn: Bound MovieDatabase method (or any blocking callable)
+
+        Returns:
+            Whatever fn returns
+        """
+        return await asyncio.to_thread(fn, *args, **kwargs)
+
+    async def _gather_limited(self, coros: List[Any], max_concurrency: int = _TMDB_MAX_CONCURRENCY) -> List[Any]:
+        """
+        Run coroutines concurrently with a bound on how many run at once.
+
+        Args:
+            coros: Coroutines to run
+            max_concurrency: Maximum number of coroutines running at the same time
+
+        Returns:
+            Results in the same order as coros; None for coroutines that raised
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def run(coro):
+            async with semaphore:
+                return await coro
+
+        results = await asyncio.gather(*(run(coro) for coro in coros), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning(f"Concurrent task failed: {result}")
+        return [None if isinstance(result, Exception) else result for result in results]
+
+    async def _generate_content_stream(self, prompt: str, generation_config: Dict[str, Any],
+                                       safety_settings: Optional[List[Dict[str, Any]]] = None) -> AsyncIterator[str]:
+        """
+        Stream a response from the LLM chunk by chunk.
+
+        The request runs without blocking the event loop. If the caller stops
+        iterating or is cancelled, generation is dropped and no further
+        chunks are read.
+
+        Args:
+            prompt: Prompt text
+            generation_config: Generation settings passed to the model
+            safety_settings: Optional safety settings passed to the model
+
+        Yields:
+            Text chunks as they arrive
+        """
+        model = await self._get_model()
+        response = await model.generate_content_async(
+            prompt,
+            generation_config=generation_config,
+            safety_settings=safety_settings,
+            stream=True
+        )
+        async for chunk in response:
+            if chunk.text:
+                yield chunk.text
+
+    async def _generate_content(self, prompt: str, generation_config: Dict[str, Any],
+                                safety_settings: Optional[List[Dict[str, Any]]] = None) -> str:
+        """
+        Generate a response with the LLM, reusing cached responses for identical requests.
+
+        Args:
+            prompt: Prompt text
+            generation_config: Generation settings passed to the model
+            safety_settings: Optional safety settings passed to the model
+
+        Returns:
+            Response text
+        """
+        model = await self._get_model()
+        key_source = repr((getattr(model, 'model_name', None), prompt,
+                           sorted(generation_config.items()), safety_settings))
+        key = hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+        cached = self._llm_cache.get(key)
+        if cached is not None:
+            self._llm_cache.move_to_end(key)
+            logger.info("LLM cache hit")
+            return cached
+
+        chunks = []
+        async for chunk in self._generate_content_stream(prompt, generation_config, safety_settings):
+            chunks.append(chunk)
+        text = "".join(chunks)
+
+        self._llm_cache[key] = text
+        if len(self._llm_cache) > _LLM_CACHE_SIZE:
+            self._llm_cache.popitem(last=False)
+        return text
+
     async def _get_free_proxies(self) -> List[str]:
         """Get a list of free proxies to try."""
         try:
@@ -187,20 +639,25 @@ class RecommendationEngine:
             Dictionary containing recommendation results
         """
         try:
-            # Get list of already rated movies to exclude them
-            excluded_movies = []
+            # НОВОЕ: Обогащаем запрос реальными данными из TMDB.
+            # Чтение предпочтений и оценок из БД не зависит от TMDB - выполняем параллельно
+            logger.info("Enriching query with TMDB data...")
             if user_id:
-                user_ratings = self.db.get_user_ratings(user_id)
-                excluded_movies = [rating['title'] for rating in user_ratings]
+                enriched_user_query, user_preferences, user_ratings = await asyncio.gather(
+                    self._enrich_query_with_tmdb_data(user_query),
+                    self._db(self.db.get_user_preferences, user_id),
+                    self._db(self.db.get_user_ratings, user_id)
+                )
+            else:
+                enriched_user_query = await self._enrich_query_with_tmdb_data(user_query)
+                user_preferences, user_ratings = [], []
 
-            # НОВОЕ: Обогащаем запрос реальными данными из TMDB
-            logger.info("Enriching query with TMDB data...")
-            enriched_user_query = await self._enrich_query_with_tmdb_data(user_query)
+            # Get list of already rated movies to exclude them (title comes from JOIN movies)
+            excluded_movies = [rating['title'] for rating in user_ratings if rating['title']]
 
             # Enhance query with user preferences if user_id is provided (but limit influence)
-            enhanced_query = enriched_user_query
+            query_parts = [enriched_user_query]
             if user_id:
-                user_preferences = self.db.get_user_preferences(user_id)
                 if user_preferences:
                     # Группируем предпочтения по типам и ограничиваем количество
                     pref_by_type = {}
@@ -220,7 +677,7 @@ class RecommendationEngine:
                     
                     if limited_preferences:
                         preferences_text = " ".join(limited_preferences)
-                        enhanced_query = f"{enriched_user_query}\n\nUser preferences (consider moderately): {preferences_text}"
+                        query_parts.append(f"User preferences (consider moderately): {preferences_text}")
 
                 # Also include user ratings if available (but limit to best rated movies only)
                 if user_ratings:
@@ -229,12 +686,13 @@ class RecommendationEngine:
                     if high_rated:
                         ratings_text = " ".join([f"{rating['title']}: {rating['rating']}/10"
                                                  for rating in high_rated])
-                        enhanced_query = f"{enhanced_query}\n\nUser's favorite movies: {ratings_text}"
+                        query_parts.append(f"User's favorite movies: {ratings_text}")
 
             # Add instruction to avoid already rated movies
             if excluded_movies:
                 excluded_text = ", ".join(excluded_movies[:10])  # Limit to avoid too long prompt
-                enhanced_query = f"{enhanced_query}\n\nDO NOT recommend these already rated movies: {excluded_text}"
+                query_parts.append(f"DO NOT recommend these already rated movies: {excluded_text}")
+            enhanced_query = "\n\n".join(query_parts)
 
             # Generate recommendations using Gemini
             system_prompt = """Ты - помощник по рекомендации фильмов. При рекомендации фильмов:
@@ -330,22 +788,21 @@ class RecommendationEngine:
                             }
 
                     # Without proxy, try regular API call
-                    response = self.model.generate_content(
+                    llm_response = await self._generate_content(
                         full_prompt,
                         generation_config=generation_config,
                         safety_settings=safety_settings
                     )
-                    llm_response = response.text
                     break
                 except Exception as e:
                     error_message = str(e)
                     logger.error(f"API error (attempt {attempt + 1}/{max_retries}): {error_message}")
 
-                    if "429" in error_message and attempt < max_retries - 1:
+                    if _is_rate_limited(e) and attempt < max_retries - 1:
+                        wait_time = _backoff_delay(retry_delay, attempt)
                         logger.warning(
-                            f"Rate limit hit, retrying in {retry_delay} seconds... ({attempt + 1}/{max_retries})")
-                        await asyncio.sleep(retry_delay)
-                        retry_delay *= 2  # Увеличиваем задержку с каждой попыткой
+                            f"Rate limit hit, retrying in {wait_time:.1f} seconds... ({attempt + 1}/{max_retries})")
+                        await asyncio.sleep(wait_time)
                     elif "403" in error_message or "User location is not supported" in error_message:
                         # Enable proxy mode for future calls
                         self.use_proxy = True
@@ -387,7 +844,7 @@ class RecommendationEngine:
                 raise Exception("Превышена квота API. Попробуйте позже.")
 
             # Parse the LLM response to extract movie titles
-            movie_titles = self._extract_movie_titles(llm_response)
+            movie_titles = await self._extract_movie_titles(llm_response)
 
             # Fetch additional details for each movie from TMDB
             detailed_recommendations = []
@@ -400,55 +857,58 @@ class RecommendationEngine:
             }
             
             excluded_movies_info = []  # Для отслеживания исключенных фильмов
-            
+            candidates = []  # Найденные фильмы, ожидающие проверки соответствия запросу
+
+            # Skip movies that user has already rated
+            titles_to_fetch = []
             for title in movie_titles:
-                # Skip movies that user has already rated
                 if title in excluded_movies:
-                    logger.info(f"Skipping already rated movie: {title}")
+                    logger.info("Skipping already rated movie: %s", title)
                     validation_summary['excluded_already_rated'] += 1
-                    continue
-                    
-                movie_details = await self._get_movie_details_from_tmdb(title)
+                else:
+                    titles_to_fetch.append(title)
+
+            # Запросы к TMDB по разным фильмам независимы - выполняем их параллельно
+            fetched_details = await self._gather_limited(
+                [self._get_movie_details_from_tmdb(title) for title in titles_to_fetch])
+            
+            # Исключенные названия приводим к нижнему регистру один раз, а не для каждой пары
+            excluded_lower = [excluded.lower() for excluded in excluded_movies]
+
+            for title, movie_details in zip(titles_to_fetch, fetched_details):
                 if not movie_details:
-                    logger.info(f"Movie not found in TMDB: {title}")
+                    logger.info("Movie not found in TMDB: %s", title)
                     validation_summary['excluded_not_found'] += 1
                     excluded_movies_info.append(f'"{title}" - не найден в TMDB')
                     continue
                 
                 # Double-check movie isn't in excluded list (by different title variations)
                 movie_title = movie_details.get('title', '')
-                original_title = movie_details.get('original_title', '')
-                
-                is_excluded = False
-                for excluded in excluded_movies:
-                    if (excluded.lower() in movie_title.lower() or 
-                        movie_title.lower() in excluded.lower() or
-                        (original_title and (excluded.lower() in original_title.lower() or 
-                                            original_title.lower() in excluded.lower()))):
-                        is_excluded = True
-                        break
                 
-                if not is_excluded:
-                    # НОВАЯ ВАЛИДАЦИЯ: Проверяем соответствие фильма запросу
-                    # Используем обогащенный запрос для более точной валидации
-                    is_valid = await self._validate_movie_match(movie_details, enriched_user_query, title)
-                    
-                    if is_valid:
-                        detailed_recommendations.append(movie_details)
-                        validation_summary['included'] += 1
-
-                        # Save movie to database if not already present
-                        existing_movie = self.db.get_movie_by_tmdb_id(movie_details.get('tmdb_id'))
-                        if not existing_movie:
-                            self.db.add_movie(movie_details)
-                    else:
-                        logger.info(f"Skipping invalid movie: '{movie_title}' - doesn't match user request")
-                        validation_summary['excluded_validation_failed'] += 1
-                        excluded_movies_info.append(f'"{movie_title}" - не соответствует запросу')
+                if not self._is_excluded_movie(movie_details, excluded_lower):
+                    candidates.append((movie_details, title))
                 else:
-                    logger.info(f"Skipping excluded movie variant: {movie_title}")
+                    logger.info("Skipping excluded movie variant: %s", movie_title)
                     validation_summary['excluded_already_rated'] += 1
 
+            # НОВАЯ ВАЛИДАЦИЯ: Проверяем соответствие фильмов запросу (пачкой, одним запросом к ИИ)
+            # Используем обогащенный запрос для более точной валидации
+            validation_results = await self._validate_movie_matches(candidates, enriched_user_query)
+
+            for (movie_details, title), is_valid in zip(candidates, validation_results):
+                movie_title = movie_details.get('title', '')
+                if is_valid:
+                    detailed_recommendations.append(movie_details)
+                    validation_summary['included'] += 1
+                else:
+                    logger.info("Skipping invalid movie: '%s' - doesn't match user request", movie_title)
+                    validation_summary['excluded_validation_failed'] += 1
+                    excluded_movies_info.append(f'"{movie_title}" - не соответствует запросу')
+
+            # Save movies to database - одной транзакцией на всю пачку
+            # (UPSERT по tmdb_id: уже сохраненные фильмы обновляются свежими данными TMDB, без лишнего SELECT)
+            await self._db(self.db.add_movies, detailed_recommendations)
+
             # НОВАЯ ЛОГИКА: Повторная генерация при недостатке валидных рекомендаций
             retry_count = 0
             max_retries = 2
@@ -458,7 +918,7 @@ class RecommendationEngine:
                    retry_count < max_retries):
                 
                 retry_count += 1
-                logger.info(f"Attempting retry {retry_count} due to insufficient valid recommendations")
+                logger.info("Attempting retry %s due to insufficient valid recommendations", retry_count)
                 
                 # Создаем список исключенных фильмов для ИИ
                 excluded_list = ", ".join(excluded_movies_info[-5:])  # Последние 5 исключенных
@@ -476,18 +936,22 @@ class RecommendationEngine:
 Порекомендуй 3-4 ДРУГИХ фильма (не из исключенных), проверив точность информации об актерах/режиссерах."""
 
                 try:
-                    retry_response = self.model.generate_content(
-                        retry_prompt,
-                        generation_config=generation_config,
-                        safety_settings=safety_settings
+                    retry_llm_response = await _retry(
+                        lambda: self._generate_content(
+                            retry_prompt,
+                            generation_config=generation_config,
+                            safety_settings=safety_settings
+                        ),
+                        retries=2,
+                        base_delay=2
                     )
-                    retry_llm_response = retry_response.text
                     
                     # Извлекаем новые рекомендации
-                    retry_movie_titles = self._extract_movie_titles(retry_llm_response)
-                    logger.info(f"Retry {retry_count} extracted {len(retry_movie_titles)} movies: {retry_movie_titles}")
+                    retry_movie_titles = await self._extract_movie_titles(retry_llm_response)
+                    logger.info("Retry %s extracted %s movies: %s", retry_count, len(retry_movie_titles), retry_movie_titles)
                     
                     # Обрабатываем новые рекомендации
+                    retry_titles = []
                     for title in retry_movie_titles:
                         # Избегаем дублирования уже обработанных фильмов
                         already_processed = any(title.lower() in processed_title.lower() 
@@ -497,8 +961,15 @@ class RecommendationEngine:
                             
                         if title in excluded_movies:
                             continue
-                            
-                        movie_details = await self._get_movie_details_from_tmdb(title)
+
+                        retry_titles.append(title)
+
+                    retry_details = await self._gather_limited(
+                        [self._get_movie_details_from_tmdb(title) for title in retry_titles])
+
+                    retry_candidates = []
+                    retry_valid = []
+                    for title, movie_details in zip(retry_titles, retry_details):
                         if not movie_details:
                             excluded_movies_info.append(f'"{title}" - не найден в TMDB (retry {retry_count})')
                             continue
@@ -507,21 +978,22 @@ class RecommendationEngine:
                         
                         # Проверка на дубликаты в уже найденных рекомендациях
                         is_duplicate = any(rec.get('title', '').lower() == movie_title.lower() 
-                                         for rec in detailed_recommendations)
+                                         for rec in detailed_recommendations + [c[0] for c in retry_candidates])
                         if is_duplicate:
                             continue
                         
-                        is_valid = await self._validate_movie_match(movie_details, enriched_user_query, title)
-                        
+                        retry_candidates.append((movie_details, title))
+
+                    retry_results = await self._validate_movie_matches(retry_candidates, enriched_user_query)
+
+                    for (movie_details, title), is_valid in zip(retry_candidates, retry_results):
+                        movie_title = movie_details.get('title', '')
                         if is_valid:
                             detailed_recommendations.append(movie_details)
                             validation_summary['included'] += 1
                             movie_titles.append(title)  # Добавляем к общему списку
-                            logger.info(f"Added valid movie from retry {retry_count}: {movie_title}")
-
-                            existing_movie = self.db.get_movie_by_tmdb_id(movie_details.get('tmdb_id'))
-                            if not existing_movie:
-                                self.db.add_movie(movie_details)
+                            logger.info("Added valid movie from retry %s: %s", retry_count, movie_title)
+                            retry_valid.append(movie_details)
                                 
                             # Если набрали достаточно рекомендаций, прерываем
                             if validation_summary['included'] >= 3:
@@ -529,6 +1001,8 @@ class RecommendationEngine:
                         else:
                             validation_summary['excluded_validation_failed'] += 1
                             excluded_movies_info.append(f'"{movie_title}" - не соответствует запросу (retry {retry_count})')
+
+                    await self._db(self.db.add_movies, retry_valid)
                     
                     # Обновляем LLM ответ с учетом повторной генерации
                     if retry_count == 1:
@@ -539,7 +1013,7 @@ class RecommendationEngine:
                     break
 
             # Логируем финальную статистику валидации
-            logger.info(f"Final validation summary after {retry_count} retries: {validation_summary}")
+            logger.info("Final validation summary after %s retries: %s", retry_count, validation_summary)
             
             # Если после повторных попыток все еще мало фильмов, добавляем пояснение
             if validation_summary['included'] < 2 and validation_summary['excluded_validation_failed'] > 0:
@@ -591,7 +1065,7 @@ class RecommendationEngine:
                 "llm_response": f"Извините, произошла ошибка при получении рекомендаций: {user_friendly_message}"
             }
 
-    def _extract_movie_titles(self, llm_response: str) -> List[str]:
+    async def _extract_movie_titles(self, llm_response: str) -> List[str]:
         """
         Extract movie titles from the LLM response.
 
@@ -602,52 +1076,34 @@ class RecommendationEngine:
             List of extracted movie titles
         """
         try:
-            # Улучшенные паттерны для извлечения названий фильмов
-            # Ищем паттерны типа **"Название фильма" (Год)** или "Название фильма" (Год)
-            title_patterns = [
-                r'\*\*"([^"]+)"\s*\((\d{4})\)\*\*',  # **"Title" (Year)**
-                r'"([^"]+)"\s*\((\d{4})\)',           # "Title" (Year)
-                r'\*\*([^*]+)\*\*\s*\((\d{4})\)',    # **Title** (Year)
-                r'«([^»]+)»\s*\((\d{4})\)',           # «Title» (Year) - русские кавычки
-                r'"([^"]+)"\s*\((\d{4})\)',           # "Title" (Year) - обычные кавычки
-            ]
-            
             extracted_titles = []
+            seen = set()
             
-            # Пробуем каждый паттерн
-            for pattern in title_patterns:
-                matches = re.findall(pattern, llm_response)
-                for match in matches:
-                    if len(match) == 2:  # title, year
-                        title, year = match
-                        full_title = f"{title.strip()} ({year})"
-                        if full_title not in extracted_titles:
-                            extracted_titles.append(full_title)
+            # Названия с годом - один проход по тексту
+            for match in _TITLE_WITH_YEAR_RE.finditer(llm_response):
+                title = match['a'] or match['b'] or match['c'] or match['d']
+                year = match['ya'] or match['yb'] or match['yc'] or match['yd']
+                full_title = f"{title.strip()} ({year})"
+                if full_title not in seen:
+                    seen.add(full_title)
+                    extracted_titles.append(full_title)
             
             # Если нашли фильмы с годами, возвращаем их
             if extracted_titles:
-                logger.info(f"Extracted titles with years: {extracted_titles}")
+                logger.info("Extracted titles with years: %s", extracted_titles)
                 return extracted_titles
             
             # Если не нашли с годами, ищем просто названия в кавычках/звездочках
-            simple_patterns = [
-                r'\*\*"([^"]+)"\*\*',     # **"Title"**
-                r'"([^"]+)"',             # "Title"
-                r'\*\*([^*]+)\*\*',       # **Title**
-                r'«([^»]+)»',             # «Title»
-            ]
-            
-            for pattern in simple_patterns:
-                matches = re.findall(pattern, llm_response)
-                for title in matches:
-                    title = title.strip()
-                    # Фильтруем слишком короткие или явно не являющиеся названиями строки
-                    if len(title) > 3 and not title.lower() in ['год', 'фильм', 'года', 'this', 'that']:
-                        if title not in extracted_titles:
-                            extracted_titles.append(title)
+            for match in _TITLE_SIMPLE_RE.finditer(llm_response):
+                title = (match['a'] or match['b'] or match['c'] or match['d']).strip()
+                # Фильтруем слишком короткие или явно не являющиеся названиями строки
+                if len(title) > 3 and title.lower() not in _NON_TITLE_WORDS:
+                    if title not in seen:
+                        seen.add(title)
+                        extracted_titles.append(title)
             
             if extracted_titles:
-                logger.info(f"Extracted simple titles: {extracted_titles}")
+                logger.info("Extracted simple titles: %s", extracted_titles)
                 return extracted_titles
 
             # Если и это не сработало, используем LLM для извлечения (более затратно)
@@ -670,41 +1126,29 @@ class RecommendationEngine:
             }
 
             # Добавляем повторные попытки при ошибке превышения квоты
-            max_retries = 2
-            retry_delay = 1  # секунды
-
-            for attempt in range(max_retries):
-                try:
-                    response = self.model.generate_content(
-                        extraction_prompt,
-                        generation_config=generation_config
-                    )
-                    extraction_result = response.text
-                    break
-                except Exception as e:
-                    if "429" in str(e) and attempt < max_retries - 1:
-                        logger.warning(f"Rate limit hit during extraction, retrying in {retry_delay} seconds...")
-                        time.sleep(retry_delay)
-                        retry_delay *= 2
-                    else:
-                        logger.warning(f"LLM extraction failed: {e}, using regex fallback")
-                        return []
-            else:
+            try:
+                extraction_result = await _retry(
+                    lambda: self._generate_content(extraction_prompt, generation_config=generation_config),
+                    retries=2,
+                    base_delay=1
+                )
+            except Exception as e:
+                logger.warning(f"LLM extraction failed: {e}, using regex fallback")
                 return []
 
             # Try to parse JSON from the response
             try:
                 # Look for JSON array in the response
-                json_match = re.search(r'\[.*\]', extraction_result, re.DOTALL)
+                json_match = _JSON_ARRAY_RE.search(extraction_result)
                 if json_match:
                     titles = json.loads(json_match.group(0))
-                    logger.info(f"LLM extracted titles: {titles}")
+                    logger.info("LLM extracted titles: %s", titles)
                     return titles
 
                 # If no JSON array found, try to extract titles with regex
-                titles = re.findall(r'"([^"]+)"', extraction_result)
+                titles = _QUOTED_RE.findall(extraction_result)
                 if titles:
-                    logger.info(f"LLM fallback extracted titles: {titles}")
+                    logger.info("LLM fallback extracted titles: %s", titles)
                     return titles
 
                 return []
@@ -740,210 +1184,183 @@ class RecommendationEngine:
             Dictionary with movie details or None if not found
         """
         try:
-            # Extract year from title if present
-            import re
-            year_match = re.search(r'\((\d{4})\)', movie_title)
-            year = year_match.group(1) if year_match else None
-
-            # Clean title by removing year and extra formatting
-            clean_title = re.sub(r'\s*\(\d{4}\)', '', movie_title).strip()
-            clean_title = clean_title.strip('"«»*')  # Remove quotes and formatting
+            # Extract year from title if present and cut it out using the same match
+            year_match = _TITLE_YEAR_RE.search(movie_title)
+            if year_match:
+                year = year_match.group(1)
+                year_int = int(year)
+                clean_title = movie_title[:year_match.start()] + movie_title[year_match.end():]
+            else:
+                year = None
+                year_int = None
+                clean_title = movie_title
+
+            # Clean title by removing extra formatting
+            clean_title = clean_title.strip().strip('"«»*')  # Remove quotes and formatting
             
-            logger.info(f"Searching for movie: '{clean_title}' (year: {year})")
+            logger.info("Searching for movie: '%s' (year: %s)", clean_title, year)
 
-            # Use httpx instead of requests for better SSL handling
-            async with httpx.AsyncClient(timeout=30.0, verify=True) as client:
-                # Search for movie in TMDB
-                search_url = f"{self.tmdb_base_url}/search/movie"
-                params = {
-                    "api_key": self.tmdb_api_key,
-                    "query": clean_title,
-                    "language": "ru-RU"
-                }
-                if year:
-                    params["year"] = year
+            # Search for movie in TMDB
+            params = {
+                "query": clean_title,
+                "language": "ru-RU"
+            }
+            if year:
+                params["year"] = year
+
+            search_results = await self._tmdb_get("/search/movie", params)
 
-                # Try up to 3 times with increasing timeout
-                max_retries = 3
-                for attempt in range(max_retries):
+            if not search_results.get('results'):
+                logger.warning(f"No TMDB results found for movie: {movie_title}")
+                # Попробуем поиск без года, если был указан год
+                if year:
+                    logger.info("Retrying search without year for: %s", clean_title)
+                    params_no_year = {
+                        "query": clean_title,
+                        "language": "ru-RU"
+                    }
                     try:
-                        response = await client.get(search_url, params=params)
-                        response.raise_for_status()
-                        search_results = response.json()
-                        break
-                    except (httpx.ConnectError, httpx.ReadError, httpx.ConnectTimeout, 
-                            httpx.ReadTimeout, ssl.SSLError) as e:
-                        if attempt < max_retries - 1:
-                            wait_time = (attempt + 1) * 2  # Exponential backoff
-                            logger.warning(f"TMDB search attempt {attempt+1} failed: {e}. Retrying in {wait_time}s...")
-                            await asyncio.sleep(wait_time)
-                        else:
-                            logger.error(f"All TMDB search attempts failed: {e}")
-                            return None
-                else:
-                    # All attempts failed
+                        search_results = await self._tmdb_get("/search/movie", params_no_year)
+                    except:
+                        logger.error(f"Retry search also failed for: {clean_title}")
+                        return None
+                
+                if not search_results.get('results'):
                     return None
 
-                if not search_results.get('results'):
-                    logger.warning(f"No TMDB results found for movie: {movie_title}")
-                    # Попробуем поиск без года, если был указан год
-                    if year:
-                        logger.info(f"Retrying search without year for: {clean_title}")
-                        params_no_year = {
-                            "api_key": self.tmdb_api_key,
-                            "query": clean_title,
-                            "language": "ru-RU"
-                        }
-                        try:
-                            response = await client.get(search_url, params=params_no_year)
-                            response.raise_for_status()
-                            search_results = response.json()
-                        except:
-                            logger.error(f"Retry search also failed for: {clean_title}")
-                            return None
-                    
-                    if not search_results.get('results'):
-                        return None
+            # Find the best match
+            best_match = None
+            best_score = 0
 
-                # Find the best match
-                best_match = None
-                best_score = 0
+            # Искомое название не меняется внутри цикла - нормализуем его один раз
+            clean_title_lower = clean_title.lower()
+            clean_words = set(clean_title_lower.split())
+            # Уровень логирования в цикле не меняется - проверяем один раз, а не на каждый результат
+            log_scores = logger.isEnabledFor(logging.INFO)
+            
+            for movie in search_results['results'][:5]:  # Check top 5 results
+                movie_title_tmdb = movie.get('title', '').lower()
+                original_title_tmdb = movie.get('original_title', '').lower()
+                movie_year = _release_year(movie.get('release_date')) or None
                 
-                for movie in search_results['results'][:5]:  # Check top 5 results
-                    movie_title_tmdb = movie.get('title', '').lower()
-                    original_title_tmdb = movie.get('original_title', '').lower()
-                    release_date = movie.get('release_date', '')
-                    movie_year = release_date[:4] if release_date else None
-                    
-                    # Calculate similarity score
-                    score = 0
-                    clean_title_lower = clean_title.lower()
-                    
-                    # Точное совпадение названия
-                    if clean_title_lower == movie_title_tmdb or clean_title_lower == original_title_tmdb:
-                        score += 100
-                    
-                    # Частичное совпадение названия
-                    elif clean_title_lower in movie_title_tmdb or movie_title_tmdb in clean_title_lower:
-                        score += 80
-                    elif clean_title_lower in original_title_tmdb or original_title_tmdb in clean_title_lower:
-                        score += 75
-                    
-                    # Совпадение по ключевым словам
-                    clean_words = set(clean_title_lower.split())
-                    title_words = set(movie_title_tmdb.split())
-                    original_words = set(original_title_tmdb.split())
-                    
-                    # Подсчет общих слов
-                    common_with_title = len(clean_words.intersection(title_words))
-                    common_with_original = len(original_words.intersection(clean_words))
-                    max_common = max(common_with_title, common_with_original)
-                    
-                    if max_common > 0:
-                        score += max_common * 20
-                    
-                    # Бонус за совпадение года
-                    if year and movie_year == year:
-                        score += 50
-                    
-                    # Штраф за большое различие в году
-                    if year and movie_year and abs(int(year) - int(movie_year)) > 2:
-                        score -= 30
-                    
-                    logger.info(f"Movie: '{movie_title_tmdb}' ({movie_year}) - Score: {score}")
-                    
-                    if score > best_score:
-                        best_score = score
-                        best_match = movie
+                # Calculate similarity score
+                score = 0
+                
+                # Точное совпадение названия
+                if clean_title_lower == movie_title_tmdb or clean_title_lower == original_title_tmdb:
+                    score += 100
+                
+                # Частичное совпадение названия
+                elif clean_title_lower in movie_title_tmdb or movie_title_tmdb in clean_title_lower:
+                    score += 80
+                elif clean_title_lower in original_title_tmdb or original_title_tmdb in clean_title_lower:
+                    score += 75
+                
+                # Совпадение по ключевым словам
+                title_words = set(movie_title_tmdb.split())
+                original_words = set(original_title_tmdb.split())
+                
+                # Подсчет общих слов
+                common_with_title = len(clean_words.intersection(title_words))
+                common_with_original = len(original_words.intersection(clean_words))
+                max_common = max(common_with_title, common_with_original)
+                
+                if max_common > 0:
+                    score += max_common * 20
+                
+                # Бонус за совпадение года
+                if year and movie_year == year:
+                    score += 50
+                
+                # Штраф за большое различие в году
+                if year and movie_year and abs(year_int - int(movie_year)) > 2:
+                    score -= 30
+                
+                if log_scores:
+                    logger.info(_MOVIE_SCORE_LOG_FMT, movie_title_tmdb, movie_year, score)
+                
+                if score > best_score:
+                    best_score = score
+                    best_match = movie
 
-                # Если лучший результат имеет слишком низкий рейтинг, не возвращаем его
-                if best_score < 40:
-                    logger.warning(f"Best match score too low ({best_score}) for: {movie_title}")
-                    return None
+            # Если лучший результат имеет слишком низкий рейтинг, не возвращаем его
+            if best_score < 40:
+                logger.warning(f"Best match score too low ({best_score}) for: {movie_title}")
+                return None
 
-                if not best_match:
-                    logger.warning(f"No suitable match found for: {movie_title}")
-                    return None
+            if not best_match:
+                logger.warning(f"No suitable match found for: {movie_title}")
+                return None
 
-                logger.info(f"Selected movie: '{best_match.get('title')}' ({best_match.get('release_date', '')[:4]}) with score: {best_score}")
+            logger.info("Selected movie: '%s' (%s) with score: %s", best_match.get('title'), best_match.get('release_date', '')[:4], best_score)
 
-                # Get detailed info for the best match
-                movie_id = best_match['id']
-                details_url = f"{self.tmdb_base_url}/movie/{movie_id}"
-                params = {
-                    "api_key": self.tmdb_api_key,
-                    "language": "ru-RU",
-                    "append_to_response": "credits,similar"
-                }
+            # Get detailed info for the best match
+            return await self._get_movie_details_by_id(best_match['id'])
 
-                # Try up to 3 times with increasing timeout
-                for attempt in range(max_retries):
-                    try:
-                        response = await client.get(details_url, params=params)
-                        response.raise_for_status()
-                        details = response.json()
-                        break
-                    except (httpx.ConnectError, httpx.ReadError, httpx.ConnectTimeout, 
-                            httpx.ReadTimeout, ssl.SSLError) as e:
-                        if attempt < max_retries - 1:
-                            wait_time = (attempt + 1) * 2  # Exponential backoff
-                            logger.warning(f"TMDB details attempt {attempt+1} failed: {e}. Retrying in {wait_time}s...")
-                            await asyncio.sleep(wait_time)
-                        else:
-                            logger.error(f"All TMDB details attempts failed: {e}")
-                            return None
-                else:
-                    # All attempts failed
-                    return None
+        except Exception as e:
+            logger.error(f"Error getting movie details from TMDB: {e}")
+            return None
 
-                # Extract directors and actors
-                directors = []
-                actors = []
-
-                if 'credits' in details:
-                    # Извлекаем режиссеров и убеждаемся, что они сохраняются как строки
-                    for crew in details['credits'].get('crew', []):
-                        if crew.get('job') == 'Director':
-                            director_name = self._normalize_text(crew.get('name', ''))
-                            if director_name:
-                                directors.append(director_name)
-
-                    # Извлекаем актеров и убеждаемся, что они сохраняются как строки
-                    for cast in details['credits'].get('cast', []):
-                        if cast.get('order', 999) < 5:  # Get top 5 billed actors
-                            actor_name = self._normalize_text(cast.get('name', ''))
-                            if actor_name:
-                                actors.append(actor_name)
-
-                # Extract genres as strings
-                genres = []
-                for genre in details.get('genres', []):
-                    genre_name = self._normalize_text(genre.get('name', ''))
-                    if genre_name:
-                        genres.append(genre_name)
-
-                # Create movie details dictionary with normalized text
-                movie_data = {
-                    'tmdb_id': details['id'],
-                    'title': self._normalize_text(details['title']),
-                    'original_title': self._normalize_text(details.get('original_title')),
-                    'overview': self._normalize_text(details.get('overview')),
-                    'release_date': self._normalize_text(details.get('release_date')),
-                    'poster_path': self._normalize_text(details.get('poster_path')),
-                    'genres': genres,
-                    'runtime': details.get('runtime'),
-                    'vote_average': details.get('vote_average'),
-                    'vote_count': details.get('vote_count'),
-                    'popularity': details.get('popularity'),
-                    'directors': directors,
-                    'actors': actors
-                }
+    async def _get_movie_details_by_id(self, tmdb_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Get movie details, credits and similar movies from TMDB in a single request.
+
+        Args:
+            tmdb_id: TMDB ID of the movie
+
+        Returns:
+            Dictionary with movie details or None if the request failed
+        """
+        try:
+            params = {
+                "language": "ru-RU",
+                "append_to_response": "credits,similar"
+            }
+            details = await self._tmdb_get(f"/movie/{tmdb_id}", params)
+
+            # Extract directors and actors
+            credits = details.get('credits', {})
+
+            # Режиссеров отбираем по job до любых преобразований, имена сохраняем строками
+            directors = [self._normalize_text(crew['name']) for crew in credits.get('crew', ())
+                         if crew.get('job') == 'Director' and crew.get('name')]
+
+            # Get top 5 billed actors
+            actors = [self._normalize_text(cast['name']) for cast in credits.get('cast', ())
+                      if cast.get('order', 999) < 5 and cast.get('name')]
+
+            # Extract genres as strings
+            genres = []
+            for genre in details.get('genres', []):
+                genre_name = self._normalize_text(genre.get('name', ''))
+                if genre_name:
+                    genres.append(genre_name)
+
+            # Create movie details dictionary with normalized text
+            movie_data = {
+                'tmdb_id': details['id'],
+                'title': self._normalize_text(details['title']),
+                'original_title': self._normalize_text(details.get('original_title')),
+                'overview': self._normalize_text(details.get('overview')),
+                'release_date': self._normalize_text(details.get('release_date')),
+                'year': _release_year(details.get('release_date')),
+                'poster_path': self._normalize_text(details.get('poster_path')),
+                'genres': genres,
+                'runtime': details.get('runtime'),
+                'vote_average': details.get('vote_average'),
+                'vote_count': details.get('vote_count'),
+                'popularity': details.get('popularity'),
+                'directors': directors,
+                'actors': actors,
+                # TMDB IDs of similar movies, returned by append_to_response
+                'similar': [similar['id'] for similar in details.get('similar', {}).get('results', [])]
+            }
 
-                logger.info(f"Successfully found movie: {movie_data['title']} ({movie_data['release_date'][:4] if movie_data['release_date'] else 'N/A'})")
-                return movie_data
+            logger.info("Successfully found movie: %s (%s)", movie_data['title'], movie_data['year'] or 'N/A')
+            return movie_data
 
         except Exception as e:
-            logger.error(f"Error getting movie details from TMDB: {e}")
+            logger.error(f"Error getting movie details by id {tmdb_id} from TMDB: {e}")
             return None
 
     async def process_user_feedback(self, user_id: int, movie_id: int, rating: int) -> bool:
@@ -952,25 +1369,25 @@ class RecommendationEngine:
 
         Args:
             user_id: Telegram user ID
-            movie_id: Database ID of the movie
+            movie_id: TMDB ID of the movie
             rating: User rating (1-10)
 
         Returns:
             True if feedback was processed successfully, False otherwise
         """
         try:
-            # Save rating to database
-            success = self.db.add_user_rating(user_id, movie_id, rating)
+            movie = await self._db(self.db.get_movie_by_tmdb_id, movie_id)
+            if not movie:
+                logger.warning(f"Movie with TMDB ID {movie_id} not found in database")
+                return False
 
-            # Add to user history
-            if success:
-                self.db.add_user_history(user_id, movie_id, f"rated_{rating}")
+            # Preferences learned from this rating are written together with it
+            new_preferences = []
 
             # Extract movie details for preference learning (only for exceptional ratings)
-            movie = self.db.get_movie_by_tmdb_id(movie_id)
-            if movie and rating >= 9:  # Only learn from exceptional ratings (9-10)
+            if rating >= 9:  # Only learn from exceptional ratings (9-10)
                 # Get current user preferences to avoid duplicates and limit quantity
-                current_preferences = self.db.get_user_preferences(user_id)
+                current_preferences = await self._db(self.db.get_user_preferences, user_id)
                 
                 # Count current preferences by type
                 pref_counts = {}
@@ -987,7 +1404,7 @@ class RecommendationEngine:
                         existing_genres = [p['preference_value'] for p in current_preferences 
                                          if p['preference_type'] == 'genre']
                         if genre not in existing_genres:
-                            self.db.add_user_preference(user_id, 'genre', genre)
+                            new_preferences.append(('genre', genre))
 
                 # Add director preferences (limit to 3 per type, only for 10/10 ratings)
                 if movie.get('directors') and rating == 10 and pref_counts.get('director', 0) < 3:
@@ -998,7 +1415,16 @@ class RecommendationEngine:
                         existing_directors = [p['preference_value'] for p in current_preferences 
                                             if p['preference_type'] == 'director']
                         if director not in existing_directors:
-                            self.db.add_user_preference(user_id, 'director', director)
+                            new_preferences.append(('director', director))
+
+            # Save rating, the matching history entry and learned preferences in a single transaction
+            def save_feedback():
+                with self.db.transaction():
+                    self.db.add_feedback([(user_id, movie['id'], rating)])
+                    self.db.add_user_preferences(user_id, new_preferences)
+
+            await self._db(save_feedback)
+            success = True
 
             return success
         except Exception as e:
@@ -1020,18 +1446,18 @@ class RecommendationEngine:
             # Get list of already rated movies to exclude them
             excluded_movies = []
             if user_id:
-                user_ratings = self.db.get_user_ratings(user_id)
-                excluded_movies = [rating['title'] for rating in user_ratings]
+                excluded_movies = await self._db(
+                    lambda: [rating['title'] for rating in self.db.iter_user_ratings(user_id) if rating['title']])
 
             # First, try to get the movie from our database
-            movie = self.db.get_movie_by_title(movie_title)
+            movie = await self._db(self.db.get_movie_by_title, movie_title)
 
             # If not in database, search TMDB
             if not movie:
                 movie_details = await self._get_movie_details_from_tmdb(movie_title)
                 if movie_details:
                     movie = movie_details
-                    self.db.add_movie(movie_details)
+                    await self._db(self.db.add_movie, movie_details)
 
             if not movie:
                 logger.warning(f"Could not find movie: {movie_title}")
@@ -1042,93 +1468,137 @@ class RecommendationEngine:
             if not tmdb_id:
                 return []
 
-            similar_url = f"{self.tmdb_base_url}/movie/{tmdb_id}/similar"
-            params = {
-                "api_key": self.tmdb_api_key,
-                "language": "ru-RU"
-            }
+            # Свежие данные из TMDB уже содержат похожие фильмы (append_to_response)
+            similar_ids = movie.get('similar')
+            if similar_ids is None:
+                params = {
+                    "language": "ru-RU"
+                }
+                similar_results = await self._tmdb_get(f"/movie/{tmdb_id}/similar", params)
+                similar_ids = [similar['id'] for similar in similar_results.get('results', [])]
 
-            # Use httpx instead of requests for better SSL handling
-            async with httpx.AsyncClient(timeout=30.0, verify=True) as client:
-                # Try up to 3 times with increasing timeout
-                max_retries = 3
-                for attempt in range(max_retries):
-                    try:
-                        response = await client.get(similar_url, params=params)
-                        response.raise_for_status()
-                        similar_results = response.json()
-                        break
-                    except (httpx.ConnectError, httpx.ReadError, httpx.ConnectTimeout, 
-                            httpx.ReadTimeout, ssl.SSLError) as e:
-                        if attempt < max_retries - 1:
-                            wait_time = (attempt + 1) * 2  # Exponential backoff
-                            logger.warning(f"TMDB similar movies attempt {attempt+1} failed: {e}. Retrying in {wait_time}s...")
-                            await asyncio.sleep(wait_time)
-                        else:
-                            logger.error(f"All TMDB similar movies attempts failed: {e}")
-                            return []
-                else:
-                    # All attempts failed
-                    return []
+            # Детали берем сразу по ID, без повторного поиска по названию, и параллельно
+            candidates = await self._gather_limited(
+                [self._get_movie_details_by_id(similar_id) for similar_id in similar_ids[:10]]  # Get more candidates to filter from
+            )
 
-                similar_movies = []
-                for similar in similar_results.get('results', [])[:10]:  # Get more candidates to filter from
-                    movie_title_candidate = self._normalize_text(similar['title'])
-                    
-                    # Skip movies that user has already rated
-                    is_excluded = False
-                    for excluded in excluded_movies:
-                        if (excluded.lower() in movie_title_candidate.lower() or 
-                            movie_title_candidate.lower() in excluded.lower()):
-                            is_excluded = True
-                            break
-                    
-                    if is_excluded:
-                        logger.info(f"Skipping already rated similar movie: {movie_title_candidate}")
-                        continue
+            excluded_lower = [excluded.lower() for excluded in excluded_movies]
+
+            similar_movies = []
+            for movie_details in candidates:
+                if movie_details:
+                    # Double-check against excluded list with original and TMDB titles
+                    movie_title = movie_details.get('title', '')
                     
-                    movie_details = await self._get_movie_details_from_tmdb(movie_title_candidate)
-                    if movie_details:
-                        # Double-check against excluded list with original and TMDB titles
-                        movie_title = movie_details.get('title', '')
-                        original_title = movie_details.get('original_title', '')
-                        
-                        is_excluded = False
-                        for excluded in excluded_movies:
-                            if (excluded.lower() in movie_title.lower() or 
-                                movie_title.lower() in excluded.lower() or
-                                (original_title and (excluded.lower() in original_title.lower() or 
-                                                    original_title.lower() in excluded.lower()))):
-                                is_excluded = True
-                                break
+                    if not self._is_excluded_movie(movie_details, excluded_lower):
+                        similar_movies.append(movie_details)
                         
-                        if not is_excluded:
-                            similar_movies.append(movie_details)
-                            self.db.add_movie(movie_details)
-                            
-                            # Stop when we have enough recommendations
-                            if len(similar_movies) >= 5:
-                                break
-                        else:
-                            logger.info(f"Skipping excluded similar movie variant: {movie_title}")
+                        # Stop when we have enough recommendations
+                        if len(similar_movies) >= 5:
+                            break
+                    else:
+                        logger.info("Skipping excluded similar movie variant: %s", movie_title)
 
-                return similar_movies
+            await self._db(self.db.add_movies, similar_movies)
+            return similar_movies
 
         except Exception as e:
             logger.error(f"Error getting similar movies: {e}")
             return []
 
-    async def _validate_movie_match(self, movie_data: Dict[str, Any], user_query: str, recommended_title: str) -> bool:
+    def _is_excluded_movie(self, movie_details: Dict[str, Any], excluded_lower: List[str]) -> bool:
         """
-        Validate if the found movie actually matches the user's request.
-        
+        Check whether a movie matches one of the excluded titles.
+
         Args:
-            movie_data: Movie details from TMDB
+            movie_details: Movie details from TMDB
+            excluded_lower: Excluded titles, already lower-cased
+
+        Returns:
+            True if the localized or original title overlaps an excluded title
+        """
+        movie_title = movie_details.get('title', '').lower()
+        original_title = (movie_details.get('original_title') or '').lower()
+        for excluded in excluded_lower:
+            if (excluded in movie_title or 
+                movie_title in excluded or
+                (original_title and (excluded in original_title or 
+                                     original_title in excluded))):
+                return True
+        return False
+
+    async def _validate_movie_matches(self, candidates: List[Tuple[Dict[str, Any], str]], user_query: str) -> List[bool]:
+        """
+        Validate several found movies against the user's request at once.
+
+        Movies that need an AI check are sent to the LLM in batches of
+        _VALIDATION_BATCH_SIZE, one prompt per batch.
+
+        Args:
+            candidates: Pairs of (movie details from TMDB, title that AI recommended)
             user_query: Original user query
-            recommended_title: Title that AI recommended
-            
+
         Returns:
-            True if movie matches the request, False otherwise
+            Validation result for each candidate, in the same order
+        """
+        query_lower = user_query.lower()
+        # Актеры и режиссеры из запроса одинаковы для всех фильмов - разбираем запрос один раз
+        requested_actors, requested_directors = self._extract_requested_people(user_query)
+
+        results: List[Optional[bool]] = []
+        for movie_data, _ in candidates:
+            result = self._check_requested_people(movie_data, requested_actors, requested_directors)
+            # Явно неподходящие по жанру фильмы отсекаем локально, не тратя запрос к ИИ
+            if result is None and self._has_incompatible_genres(
+                    {g.lower() for g in movie_data.get('genres', [])}, query_lower):
+                result = False
+            results.append(result)
+
+        # ИИ проверяет только фильмы, для которых не было строгих проверок по актерам/режиссерам
+        pending = [i for i, result in enumerate(results) if result is None]
+        batches = [pending[i:i + _VALIDATION_BATCH_SIZE] for i in range(0, len(pending), _VALIDATION_BATCH_SIZE)]
+        batch_results = await asyncio.gather(*(
+            self._ai_validate_batch([candidates[i] for i in batch], user_query) for batch in batches))
+
+        for batch, batch_result in zip(batches, batch_results):
+            for i, is_valid in zip(batch, batch_result):
+                results[i] = is_valid
+        return results
+
+    def _extract_requested_people(self, user_query: str) -> Tuple[set, set]:
+        """
+        Find actors and directors named in the user's request.
+
+        Args:
+            user_query: Original user query
+
+        Returns:
+            Lower-cased normalized names of requested actors and directors
+        """
+        requested_actors = {
+            self._normalize_person_name(match.strip()).lower()
+            for match in _union_findall(_ACTOR_RE, user_query)
+        }
+        requested_directors = {
+            self._normalize_person_name(match.strip()).lower()
+            for match in _union_findall(_DIRECTOR_RE, user_query)
+        }
+
+        return requested_actors, requested_directors
+
+    def _check_requested_people(self, movie_data: Dict[str, Any], requested_actors: set,
+                                requested_directors: set) -> Optional[bool]:
+        """
+        Check that actors and directors named in the query take part in the movie.
+
+        Args:
+            movie_data: Movie details from TMDB
+            requested_actors: Requested actors from _extract_requested_people
+            requested_directors: Requested directors from _extract_requested_people
+
+        Returns:
+            False if a requested person is missing, True if all requested people
+            were found, None if the query names nobody and an AI check is needed
         """
         try:
             # Базовые проверки
@@ -1137,28 +1607,10 @@ class RecommendationEngine:
             
             # Получаем данные о фильме
             title = movie_data.get('title', '')
-            original_title = movie_data.get('original_title', '')
-            overview = movie_data.get('overview', '')
-            genres = movie_data.get('genres', [])
-            release_date = movie_data.get('release_date', '')
-            year = release_date[:4] if release_date else ''
             actors = movie_data.get('actors', [])
             directors = movie_data.get('directors', [])
             
             # НОВАЯ ПРОВЕРКА: Специальная валидация для запросов с актерами
-            actor_patterns = [
-                r'с\s+([А-ЯЁ][а-яё]+[ыоауеймх]?\s+[А-ЯЁ][а-яё]+[ыоауеймх]?)',
-                r'актер[а-я]*\s+([А-ЯЁ][а-яё]+[ауы]?\s+[А-ЯЁ][а-яё]+[ауы]?)',
-                r'участие[мн]\s+([А-ЯЁ][а-яё]+[ауы]?\s+[А-ЯЁ][а-яё]+[ауы]?)',
-            ]
-            
-            requested_actors = set()
-            for pattern in actor_patterns:
-                matches = re.findall(pattern, user_query)
-                for match in matches:
-                    normalized_name = self._normalize_person_name(match.strip())
-                    requested_actors.add(normalized_name.lower())
-            
             # Если в запросе указан конкретный актер, проверяем его участие
             if requested_actors:
                 movie_actors_lower = [actor.lower() for actor in actors]
@@ -1178,18 +1630,6 @@ class RecommendationEngine:
                         return False
             
             # НОВАЯ ПРОВЕРКА: Специальная валидация для запросов с режиссерами  
-            director_patterns = [
-                r'от\s+(?:режиссера\s+)?([А-ЯЁ][а-яё]+[ауы]?\s+[А-ЯЁ][а-яё]+[ауы]?)',
-                r'режиссер[а-я]*\s+([А-ЯЁ][а-яё]+[ауы]?\s+[А-ЯЁ][а-яё]+[ауы]?)',
-            ]
-            
-            requested_directors = set()
-            for pattern in director_patterns:
-                matches = re.findall(pattern, user_query)
-                for match in matches:
-                    normalized_name = self._normalize_person_name(match.strip())
-                    requested_directors.add(normalized_name.lower())
-            
             # Если в запросе указан конкретный режиссер, проверяем его участие
             if requested_directors:
                 movie_directors_lower = [director.lower() for director in directors]
@@ -1207,71 +1647,122 @@ class RecommendationEngine:
                         logger.warning(f"Requested director '{requested_director}' not found in '{title}' crew: {directors}")
                         return False
             
-            # Создаем описание фильма для проверки
-            movie_description = f"""
-Название: {title}
-Оригинальное название: {original_title}
+            # Если прошли все строгие проверки
+            if requested_actors or requested_directors:
+                return True
+            return None
+                
+        except Exception as e:
+            logger.error(f"Error during movie validation: {e}")
+            return True  # В случае ошибки разрешаем фильм
+
+    def _describe_movie(self, movie_data: Dict[str, Any]) -> str:
+        """Build a short movie description for validation prompts."""
+        year = movie_data.get('year')
+        if year is None:
+            year = _release_year(movie_data.get('release_date'))
+        return f"""
+Название: {movie_data.get('title', '')}
+Оригинальное название: {movie_data.get('original_title', '')}
 Год: {year}
-Жанры: {', '.join(genres)}
-Актеры: {', '.join(actors[:5])}
-Режиссеры: {', '.join(directors)}
-Описание: {overview}
+Жанры: {', '.join(movie_data.get('genres', []))}
+Актеры: {', '.join(movie_data.get('actors', [])[:5])}
+Режиссеры: {', '.join(movie_data.get('directors', []))}
+Описание: {movie_data.get('overview', '')}
 """
-            
-            # Используем ИИ для проверки соответствия (только если не было строгих проверок выше)
-            if not requested_actors and not requested_directors:
-                validation_prompt = f"""Проанализируй, соответствует ли найденный фильм пользовательскому запросу.
 
-ПОЛЬЗОВАТЕЛЬСКИЙ ЗАПРОС: {user_query}
+    async def _ai_validate_batch(self, candidates: List[Tuple[Dict[str, Any], str]], user_query: str) -> List[bool]:
+        """
+        Ask the LLM whether each movie matches the request, using a single prompt.
 
+        Args:
+            candidates: Pairs of (movie details from TMDB, title that AI recommended)
+            user_query: Original user query
+
+        Returns:
+            Validation result for each candidate; fallback validation is used
+            if the LLM call fails or its answer cannot be parsed
+        """
+        movies_block = "\n".join(
+            f"""ФИЛЬМ {number}
 РЕКОМЕНДОВАННЫЙ БОТОМ ФИЛЬМ: {recommended_title}
+НАЙДЕННЫЙ В БАЗЕ ФИЛЬМ:{self._describe_movie(movie_data)}"""
+            for number, (movie_data, recommended_title) in enumerate(candidates, 1))
+
+        validation_prompt = f"""Проанализируй, соответствуют ли найденные фильмы пользовательскому запросу.
 
-НАЙДЕННЫЙ В БАЗЕ ФИЛЬМ:
-{movie_description}
+ПОЛЬЗОВАТЕЛЬСКИЙ ЗАПРОС: {user_query}
 
-Вопросы для анализа:
+{movies_block}
+Вопросы для анализа каждого фильма:
 1. Соответствуют ли жанры найденного фильма запросу пользователя?
 2. Подходит ли описание фильма под запрос?
 3. Это тот же фильм, который рекомендовал бот, или совершенно другой?
 
-Ответь ТОЛЬКО одним словом:
+Ответь ТОЛЬКО JSON массивом из {len(candidates)} строк в порядке номеров фильмов:
 - "ДА" - если фильм соответствует запросу
 - "НЕТ" - если фильм НЕ соответствует запросу
 
 Ответ:"""
 
-                # Настройки для быстрой валидации
-                generation_config = {
-                    "temperature": 0.1,
-                    "top_p": 0.9,
-                    "top_k": 20,
-                    "max_output_tokens": 10,  # Очень мало токенов - нужен только ДА/НЕТ
-                }
+        # Настройки для быстрой валидации
+        generation_config = {
+            "temperature": 0.1,
+            "top_p": 0.9,
+            "top_k": 20,
+            "max_output_tokens": 10 * len(candidates) + 10,  # Очень мало токенов - нужен только ДА/НЕТ на фильм
+        }
 
-                try:
-                    response = self.model.generate_content(
-                        validation_prompt,
-                        generation_config=generation_config
-                    )
-                    validation_result = response.text.strip().upper()
-                    
-                    # Проверяем ответ
-                    is_valid = "ДА" in validation_result or "YES" in validation_result
-                    
-                    logger.info(f"AI validation for '{title}': {validation_result} -> {'VALID' if is_valid else 'INVALID'}")
-                    return is_valid
-                    
-                except Exception as e:
-                    logger.warning(f"AI validation failed, using fallback validation: {e}")
-                    # Fallback валидация без ИИ
-                    return self._fallback_validation(movie_data, user_query)
-            
-            # Если прошли все строгие проверки
-            return True
-                
+        try:
+            validation_result = await self._generate_content(
+                validation_prompt,
+                generation_config=generation_config
+            )
+            answers = self._parse_validation_answers(validation_result, len(candidates))
+            if answers is None:
+                raise ValueError(f"unexpected validation answer: {validation_result!r}")
         except Exception as e:
-            logger.error(f"Error during movie validation: {e}")
-            return True  # В случае ошибки разрешаем фильм
+            logger.warning(f"AI validation failed, using fallback validation: {e}")
+            # Fallback валидация без ИИ
+            return [self._fallback_validation(movie_data, user_query) for movie_data, _ in candidates]
+
+        results = []
+        for (movie_data, _), answer in zip(candidates, answers):
+            # Проверяем ответ
+            is_valid = "ДА" in answer or "YES" in answer
+            logger.info("AI validation for '%s': %s -> %s", movie_data.get('title', ''), answer, 'VALID' if is_valid else 'INVALID')
+            results.append(is_valid)
+        return results
+
+    def _parse_validation_answers(self, text: str, expected: int) -> Optional[List[str]]:
+        """
+        Parse the LLM answer to a batch validation prompt.
+
+        Args:
+            text: Raw LLM response
+            expected: Number of movies in the batch
+
+        Returns:
+            Upper-cased answers in order, or None if the response does not
+            contain exactly one answer per movie
+        """
+        json_match = _JSON_ARRAY_RE.search(text)
+        if json_match:
+            try:
+                answers = [str(answer).strip().upper() for answer in json.loads(json_match.group(0))]
+                if len(answers) == expected:
+                    return answers
+            except ValueError:
+                pass
+
+        # Запасной вариант: ответы построчно ("1. ДА")
+        answers = [answer.upper() for answer in _NUMBERED_ANSWER_RE.findall(text)]
+        if len(answers) == expected:
+            return answers
+        # Одиночный фильм: допускаем ответ одним словом, как раньше
+        if expected == 1:
+            return [text.strip().upper()]
+        return None
 
     def _names_match(self, name1: str, name2: str) -> bool:
         """
@@ -1285,51 +1776,58 @@ class RecommendationEngine:
             True if names likely refer to the same person
         """
         try:
-            # Разбиваем имена на части
-            parts1 = name1.split()
-            parts2 = name2.split()
-            
-            if len(parts1) >= 2 and len(parts2) >= 2:
-                # Проверяем совпадение имени и фамилии
-                first_match = any(p1 in p2 or p2 in p1 for p1 in parts1[:1] for p2 in parts2[:1])
-                last_match = any(p1 in p2 or p2 in p1 for p1 in parts1[-1:] for p2 in parts2[-1:])
-                
-                return first_match and last_match
-            
-            return False
+            # Разбиваем имена на части (разбор кэшируется)
+            parts1 = _name_parts(name1)
+            parts2 = _name_parts(name2)
+            if not parts1 or not parts2:
+                return False
+
+            first1, last1 = parts1
+            first2, last2 = parts2
+            # Сначала фамилия - она отсекает почти всех чужих актеров, имя проверяем только после нее
+            if not (last1 in last2 or last2 in last1):
+                return False
+            return first1 in first2 or first2 in first1
         except:
             return False
 
+    def _has_incompatible_genres(self, genres: Set[str], query_lower: str) -> bool:
+        """
+        Cheap local check for movies whose genres clearly contradict the request.
+
+        Only the rule that _fallback_validation applies to every query lives here:
+        action requested, but the movie is a romance or comedy.
+
+        Args:
+            genres: Lower-cased movie genres
+            query_lower: Lower-cased user query
+
+        Returns:
+            True if the movie has a genre incompatible with the request
+        """
+        if any(word in query_lower for word in ['боевик', 'экшн', 'action']):
+            if not genres.isdisjoint(_COMEDY_ROMANCE_GENRES):
+                logger.info("Requested action but found romance/comedy: %s", genres)
+                return True
+        return False
+
     def _fallback_validation(self, movie_data: Dict[str, Any], user_query: str) -> bool:
         """
         Fallback validation without AI when AI validation fails.
         """
         try:
-            genres = [g.lower() for g in movie_data.get('genres', [])]
+            # Множество жанров фильма: проверки ниже - пересечения множеств, а не вложенные any()
+            genres = {g.lower() for g in movie_data.get('genres', [])}
             query_lower = user_query.lower()
             overview = movie_data.get('overview', '').lower()
             
-            # Проверяем ключевые слова в запросе и соответствие жанров
-            genre_keywords = {
-                'боевик': ['боевик', 'экшн', 'action'],
-                'комедия': ['комедия', 'comedy'],
-                'драма': ['драма', 'drama'],
-                'ужасы': ['ужасы', 'хоррор', 'horror'],
-                'фантастика': ['фантастика', 'sci-fi', 'научная фантастика'],
-                'триллер': ['триллер', 'thriller'],
-                'мелодрама': ['мелодрама', 'романтика', 'romance'],
-                'детектив': ['детектив', 'mystery'],
-                'анимация': ['анимация', 'мультфильм', 'animation'],
-                'документальный': ['документальный', 'documentary']
-            }
-            
             # Определяем ожидаемые жанры на основе запроса
-            expected_genres = []
+            expected_genres = set()
             found_keywords = []
             
-            for keyword, genre_list in genre_keywords.items():
+            for keyword, genre_list in _FALLBACK_GENRE_KEYWORDS.items():
                 if keyword in query_lower:
-                    expected_genres.extend(genre_list)
+                    expected_genres.update(genre_list)
                     found_keywords.append(keyword)
             
             # Специальные проверки для конкретных запросов
@@ -1338,49 +1836,36 @@ class RecommendationEngine:
             if any(word in query_lower for word in ['женщин', 'женской', 'героиня', 'девушк']):
                 # Если просят фильм с женщиной в главной роли, проверяем описание
                 if not any(word in overview for word in ['женщин', 'девушк', 'героиня', 'woman', 'female', 'girl']):
-                    logger.info(f"Movie doesn't seem to have female protagonist despite request")
+                    logger.info("Movie doesn't seem to have female protagonist despite request")
                     
             # Проверка несоответствия жанров (исключения)
-            comedy_romance_indicators = ['мелодрама', 'комедия', 'романтический', 'романтика']
-            if any(word in query_lower for word in ['боевик', 'экшн', 'action']):
-                # Если просят боевик, но нашли мелодраму/комедию
-                if any(genre in genres for genre in comedy_romance_indicators):
-                    logger.info(f"Requested action but found romance/comedy: {genres}")
-                    return False
+            if self._has_incompatible_genres(genres, query_lower):
+                return False
             
             # Если нашли ожидаемые жанры, проверяем соответствие
             if expected_genres:
-                has_matching_genre = any(genre in genres for genre in expected_genres)
+                has_matching_genre = not genres.isdisjoint(expected_genres)
                 
                 # Дополнительная проверка для боевиков
                 if 'боевик' in found_keywords:
-                    action_genres = ['боевик', 'экшн', 'триллер', 'криминал', 'приключения']
-                    has_action = any(genre in genres for genre in action_genres)
+                    has_action = not genres.isdisjoint(_ACTION_GENRES)
                     
                     # Если это явно НЕ боевик (мелодрама, комедия без экшена)
-                    non_action_genres = ['мелодрама', 'комедия', 'документальный']
-                    is_non_action = any(genre in genres for genre in non_action_genres)
+                    is_non_action = not genres.isdisjoint(_NON_ACTION_GENRES)
                     
                     if is_non_action and not has_action:
-                        logger.info(f"Requested action but found non-action genres: {genres}")
+                        logger.info("Requested action but found non-action genres: %s", genres)
                         return False
                 
-                logger.info(f"Fallback validation: Expected {expected_genres}, Found {genres}, Match: {has_matching_genre}")
+                logger.info("Fallback validation: Expected %s, Found %s, Match: %s", expected_genres, genres, has_matching_genre)
                 return has_matching_genre
             
             # Если не смогли определить жанр из запроса, делаем базовую проверку
             # Проверяем, что это не явно неподходящий фильм
-            non_matching_patterns = [
-                ('боевик', ['мелодрама', 'комедия', 'документальный']),
-                ('ужасы', ['комедия', 'мелодрама', 'детский']),
-                ('комедия', ['ужасы', 'триллер', 'драма']),
-                ('детск', ['ужасы', 'триллер', 'взрослый'])
-            ]
-            
-            for request_pattern, incompatible_genres in non_matching_patterns:
+            for request_pattern, incompatible_genres in _INCOMPATIBLE_GENRES:
                 if request_pattern in query_lower:
-                    if any(genre in genres for genre in incompatible_genres):
-                        logger.info(f"Incompatible genres found for '{request_pattern}': {genres}")
+                    if not genres.isdisjoint(incompatible_genres):
+                        logger.info("Incompatible genres found for '%s': %s", request_pattern, genres)
                         return False
             
             # По умолчанию разрешаем, если не нашли явных противоречий
@@ -1401,43 +1886,34 @@ class RecommendationEngine:
             Person information from TMDB or None if not found
         """
         try:
-            async with httpx.AsyncClient(timeout=15.0, verify=True) as client:
-                search_url = f"{self.tmdb_base_url}/search/person"
+            params = {
+                "query": person_name,
+                "language": "ru-RU"
+            }
+            
+            search_results = await self._tmdb_get("/search/person", params)
+            
+            if search_results.get('results'):
+                person = search_results['results'][0]  # Берем первый результат
+                
+                # Получаем детальную информацию о человеке
+                person_id = person['id']
                 params = {
-                    "api_key": self.tmdb_api_key,
-                    "query": person_name,
-                    "language": "ru-RU"
+                    "language": "ru-RU",
+                    "append_to_response": "movie_credits"
                 }
                 
-                response = await client.get(search_url, params=params)
-                response.raise_for_status()
-                search_results = response.json()
+                person_details = await self._tmdb_get(f"/person/{person_id}", params)
                 
-                if search_results.get('results'):
-                    person = search_results['results'][0]  # Берем первый результат
-                    
-                    # Получаем детальную информацию о человеке
-                    person_id = person['id']
-                    details_url = f"{self.tmdb_base_url}/person/{person_id}"
-                    params = {
-                        "api_key": self.tmdb_api_key,
-                        "language": "ru-RU",
-                        "append_to_response": "movie_credits"
-                    }
-                    
-                    response = await client.get(details_url, params=params)
-                    response.raise_for_status()
-                    person_details = response.json()
-                    
-                    return person_details
-                    
-                return None
+                return person_details
                 
+            return None
+            
         except Exception as e:
             logger.error(f"Error searching person in TMDB: {e}")
             return None
 
-    async def _get_movies_by_genre(self, genre_name: str, limit: int = 10) -> List[Dict[str, Any]]:
+    async def _get_movies_by_genre(self, genre_name: str, limit: int = 10) -> List[MovieSummary]:
         """
         Get popular movies by genre from TMDB.
         
@@ -1476,39 +1952,36 @@ class RecommendationEngine:
                 logger.warning(f"Genre '{genre_name}' not found in mapping")
                 return []
             
-            async with httpx.AsyncClient(timeout=15.0, verify=True) as client:
-                discover_url = f"{self.tmdb_base_url}/discover/movie"
-                params = {
-                    "api_key": self.tmdb_api_key,
-                    "with_genres": genre_id,
-                    "language": "ru-RU",
-                    "sort_by": "popularity.desc",
-                    "page": 1
-                }
-                
-                response = await client.get(discover_url, params=params)
-                response.raise_for_status()
-                results = response.json()
-                
-                movies = []
-                for movie in results.get('results', [])[:limit]:
-                    movie_info = {
-                        'title': movie.get('title', ''),
-                        'original_title': movie.get('original_title', ''),
-                        'release_date': movie.get('release_date', ''),
-                        'overview': movie.get('overview', ''),
-                        'vote_average': movie.get('vote_average', 0),
-                        'tmdb_id': movie.get('id')
-                    }
-                    movies.append(movie_info)
-                
-                return movies
-                
+            params = {
+                "with_genres": genre_id,
+                "language": "ru-RU",
+                "sort_by": "popularity.desc",
+                "page": 1
+            }
+            
+            results = await self._tmdb_get("/discover/movie", params)
+            
+            # Записи без id бесполезны - отбрасываем их до создания объектов
+            movies = [
+                MovieSummary(
+                    tmdb_id=movie['id'],
+                    title=movie.get('title', ''),
+                    original_title=movie.get('original_title', ''),
+                    release_date=movie.get('release_date', ''),
+                    vote_average=movie.get('vote_average', 0),
+                    overview=movie.get('overview', '')
+                )
+                for movie in results.get('results', ())
+                if movie.get('id') is not None
+            ]
+            
+            return movies[:limit]
+            
         except Exception as e:
             logger.error(f"Error getting movies by genre: {e}")
             return []
 
-    async def _get_person_filmography(self, person_name: str, role: str = 'cast') -> List[Dict[str, Any]]:
+    async def _get_person_filmography(self, person_name: str, role: str = 'cast') -> List[MovieSummary]:
         """
         Get filmography of a person (actor or director).
         
@@ -1526,28 +1999,30 @@ class RecommendationEngine:
             
             movie_credits = person_details.get('movie_credits', {})
             
+            # Записи без id бесполезны - отбрасываем их до создания объектов
             if role == 'cast':
-                credits = movie_credits.get('cast', [])
+                credits = [c for c in movie_credits.get('cast', ()) if c.get('id') is not None]
             else:  # crew
-                credits = movie_credits.get('crew', [])
                 # Фильтруем только режиссеров
-                credits = [c for c in credits if c.get('job') == 'Director']
+                credits = [c for c in movie_credits.get('crew', ())
+                           if c.get('job') == 'Director' and c.get('id') is not None]
             
-            movies = []
-            for credit in credits[:15]:  # Ограничиваем до 15 фильмов
-                movie_info = {
-                    'title': credit.get('title', ''),
-                    'original_title': credit.get('original_title', ''),
-                    'release_date': credit.get('release_date', ''),
-                    'character': credit.get('character', '') if role == 'cast' else '',
-                    'job': credit.get('job', '') if role == 'crew' else '',
-                    'vote_average': credit.get('vote_average', 0),
-                    'tmdb_id': credit.get('id')
-                }
-                movies.append(movie_info)
+            is_cast = role == 'cast'
+            movies = [  # Ограничиваем до 15 фильмов
+                MovieSummary(
+                    tmdb_id=credit['id'],
+                    title=credit.get('title', ''),
+                    original_title=credit.get('original_title', ''),
+                    release_date=credit.get('release_date', ''),
+                    vote_average=credit.get('vote_average', 0),
+                    character=credit.get('character', '') if is_cast else '',
+                    job='' if is_cast else credit.get('job', '')
+                )
+                for credit in credits[:15]
+            ]
             
             # Сортируем по популярности/рейтингу
-            movies.sort(key=lambda x: x['vote_average'], reverse=True)
+            movies.sort(key=lambda x: x.vote_average, reverse=True)
             return movies[:10]  # Возвращаем топ-10
             
         except Exception as e:
@@ -1557,6 +2032,9 @@ class RecommendationEngine:
     async def _enrich_query_with_tmdb_data(self, user_query: str) -> str:
         """
         Enrich user query with real data from TMDB API.
+
+        Results are cached for _ENRICH_CACHE_TTL seconds, and concurrent
+        enrichment of the same query shares one computation.
         
         Args:
             user_query: Original user query
@@ -1564,105 +2042,113 @@ class RecommendationEngine:
         Returns:
             Enhanced query with real TMDB data
         """
+        now = time.time()
+        cached = self._enrich_cache.get(user_query)
+        if cached is not None:
+            cached_at, enhanced_query = cached
+            if now - cached_at < _ENRICH_CACHE_TTL:
+                self._enrich_cache.move_to_end(user_query)
+                logger.info("Enriched query cache hit")
+                return enhanced_query
+            del self._enrich_cache[user_query]
+
+        task = self._enrich_inflight.get(user_query)
+        if task is None:
+            task = asyncio.ensure_future(self._build_enriched_query(user_query))
+            self._enrich_inflight[user_query] = task
+            task.add_done_callback(lambda _: self._enrich_inflight.pop(user_query, None))
+        enhanced_query = await asyncio.shield(task)
+
+        self._enrich_cache[user_query] = (now, enhanced_query)
+        if len(self._enrich_cache) > _ENRICH_CACHE_SIZE:
+            self._enrich_cache.popitem(last=False)
+        return enhanced_query
+
+    async def _build_enriched_query(self, user_query: str) -> str:
+        """
+        Build the enriched query from TMDB lookups (uncached).
+
+        Args:
+            user_query: Original user query
+
+        Returns:
+            Enhanced query with real TMDB data, or the original query on error
+        """
         try:
-            enhanced_query = user_query
+            # Части запроса собираем в список и склеиваем один раз в конце
+            query_parts = [user_query]
             query_lower = user_query.lower()
             
             # Сначала ищем упоминания конкретных фильмов (приоритет выше персон)
-            movie_patterns = [
-                r'"([^"]+)"',  # фильмы в кавычках
-                r'как\s+([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)*)',  # "как Интерстеллар", "как Джон Уик"
-                r'типа\s+([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)*)',  # "типа Матрицы", "типа Джон Уик"  
-                r'похож[а-я]*\s+на\s+([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)*)',  # "похожие на Джон Уик"
-            ]
-            
             found_movies = set()
-            for pattern in movie_patterns:
-                matches = re.findall(pattern, user_query)
-                for match in matches:
-                    movie_title = match.strip()
-                    # Исключаем слишком короткие или служебные слова
-                    if len(movie_title) > 2 and movie_title not in ['Все', 'Что', 'Как', 'Где', 'Это', 'Там']:
-                        found_movies.add(movie_title)
+            for match in _union_findall(_MOVIE_MENTION_RE, user_query):
+                movie_title = match.strip()
+                # Исключаем слишком короткие или служебные слова
+                if len(movie_title) > 2 and movie_title not in ['Все', 'Что', 'Как', 'Где', 'Это', 'Там']:
+                    found_movies.add(movie_title)
+            
+            # Ищем упоминания актеров/режиссеров (исключаем уже найденные фильмы)
+            found_persons = set()
+            for match in _union_findall(_PERSON_MENTION_RE, user_query):
+                if len(match.split()) == 2:  # Имя и фамилия
+                    person_name = match.strip()
+                    # Исключаем названия фильмов
+                    if person_name not in found_movies:
+                        # Преобразуем падежи в именительный падеж (базовая нормализация)
+                        normalized_name = self._normalize_person_name(person_name)
+                        found_persons.add(normalized_name)
             
+            # Ищем упоминания жанров (один проход регулярки)
+            found_genres = list(dict.fromkeys(
+                _GENRE_BY_KEYWORD[keyword] for keyword in _GENRE_KEYWORD_RE.findall(query_lower)))
+
+            # Все запросы к TMDB независимы - выполняем их параллельно
+            movie_titles = list(found_movies)[:2]  # Ограничиваем до 2 фильмов
+            person_names = list(found_persons)[:2]  # Ограничиваем до 2 персон
+            genre_names = found_genres[:2]  # Ограничиваем до 2 жанров
+
+            logger.info("Searching TMDB data for movies: %s, persons: %s, genres: %s", movie_titles, person_names, genre_names)
+
+            movie_results, person_results, genre_results = await asyncio.gather(
+                asyncio.gather(*(self._get_movie_details_from_tmdb(title) for title in movie_titles)),
+                asyncio.gather(*(
+                    asyncio.gather(self._get_person_filmography(name, 'cast'),
+                                   self._get_person_filmography(name, 'crew'))
+                    for name in person_names)),
+                asyncio.gather(*(self._get_movies_by_genre(genre, 5) for genre in genre_names))
+            )
+
             # Получаем информацию о найденных фильмах
-            for movie_title in list(found_movies)[:2]:  # Ограничиваем до 2 фильмов
-                logger.info(f"Searching TMDB data for movie: {movie_title}")
-                movie_details = await self._get_movie_details_from_tmdb(movie_title)
+            for movie_details in movie_results:
                 if movie_details:
                     genres_str = ", ".join(movie_details.get('genres', []))
                     directors_str = ", ".join(movie_details.get('directors', []))
-                    enhanced_query += f"\n\nИнформация из TMDB о фильме \"{movie_details['title']}\": жанры - {genres_str}, режиссер - {directors_str}, рейтинг - {movie_details.get('vote_average', 'N/A')}/10"
+                    query_parts.append(f"Информация из TMDB о фильме \"{movie_details['title']}\": жанры - {genres_str}, режиссер - {directors_str}, рейтинг - {movie_details.get('vote_average', 'N/A')}/10")
 
-            # Ищем упоминания актеров/режиссеров (исключаем уже найденные фильмы)
-            person_patterns = [
-                r'с\s+([А-ЯЁ][а-яё]+[ыоауеймх]?\s+[А-ЯЁ][а-яё]+[ыоауеймх]?)',  # "с Томом Хэнксом" 
-                r'от\s+(?:режиссера\s+)?([А-ЯЁ][а-яё]+[ауы]?\s+[А-ЯЁ][а-яё]+[ауы]?)',  # "от Стивена Спилберга"
-                r'актер[а-я]*\s+([А-ЯЁ][а-яё]+[ауы]?\s+[А-ЯЁ][а-яё]+[ауы]?)',  # "актера Роберта Дауни"
-                r'режиссер[а-я]*\s+([А-ЯЁ][а-яё]+[ауы]?\s+[А-ЯЁ][а-яё]+[ауы]?)',  # "режиссера Кристофера Нолана"
-            ]
-            
-            found_persons = set()
-            for pattern in person_patterns:
-                matches = re.findall(pattern, user_query)
-                for match in matches:
-                    if len(match.split()) == 2:  # Имя и фамилия
-                        person_name = match.strip()
-                        # Исключаем названия фильмов
-                        if person_name not in found_movies:
-                            # Преобразуем падежи в именительный падеж (базовая нормализация)
-                            normalized_name = self._normalize_person_name(person_name)
-                            found_persons.add(normalized_name)
-            
             # Получаем информацию о найденных персонах
-            for person_name in list(found_persons)[:2]:  # Ограничиваем до 2 персон
-                logger.info(f"Searching TMDB data for person: {person_name}")
-                
-                # Получаем фильмографию как актера
-                actor_movies = await self._get_person_filmography(person_name, 'cast')
+            for person_name, (actor_movies, director_movies) in zip(person_names, person_results):
+                # Фильмография как актера
                 if actor_movies:
-                    movies_list = ", ".join([f'"{m["title"]}" ({m["release_date"][:4] if m["release_date"] else "N/A"})' 
+                    movies_list = ", ".join([f'"{m.title}" ({m.year or "N/A"})' 
                                            for m in actor_movies[:5]])
-                    enhanced_query += f"\n\nИнформация из TMDB - {person_name} как актер снимался в: {movies_list}"
+                    query_parts.append(f"Информация из TMDB - {person_name} как актер снимался в: {movies_list}")
                 
-                # Получаем фильмографию как режиссера
-                director_movies = await self._get_person_filmography(person_name, 'crew')
+                # Фильмография как режиссера
                 if director_movies:
-                    movies_list = ", ".join([f'"{m["title"]}" ({m["release_date"][:4] if m["release_date"] else "N/A"})' 
+                    movies_list = ", ".join([f'"{m.title}" ({m.year or "N/A"})' 
                                            for m in director_movies[:5]])
-                    enhanced_query += f"\n\nИнформация из TMDB - {person_name} как режиссер снял: {movies_list}"
-            
-            # Ищем упоминания жанров и получаем популярные фильмы
-            genre_keywords = {
-                'боевик': ['боевик', 'боевики', 'экшн', 'action'],
-                'комедия': ['комедия', 'комедии', 'comedy'],
-                'драма': ['драма', 'драмы', 'drama'],
-                'ужасы': ['ужасы', 'ужас', 'хоррор', 'horror'],
-                'фантастика': ['фантастика', 'фантастику', 'sci-fi', 'научная фантастика'],
-                'триллер': ['триллер', 'триллеры', 'thriller'],
-                'мелодрама': ['мелодрама', 'мелодрамы', 'романтика', 'романтику', 'romance'],
-                'детектив': ['детектив', 'детективы', 'mystery'],
-                'анимация': ['анимация', 'анимационный', 'мультфильм', 'мультфильмы', 'animation'],
-                'документальный': ['документальный', 'документальные', 'documentary']
-            }
+                    query_parts.append(f"Информация из TMDB - {person_name} как режиссер снял: {movies_list}")
             
-            found_genres = []
-            for genre, keywords in genre_keywords.items():
-                if any(keyword in query_lower for keyword in keywords):
-                    found_genres.append(genre)
-            
-            # Получаем популярные фильмы для найденных жанров
-            for genre in found_genres[:2]:  # Ограничиваем до 2 жанров
-                logger.info(f"Getting popular movies for genre: {genre}")
-                popular_movies = await self._get_movies_by_genre(genre, 5)
+            # Популярные фильмы для найденных жанров
+            for genre, popular_movies in zip(genre_names, genre_results):
                 if popular_movies:
-                    movies_list = ", ".join([f'"{m["title"]}" ({m["release_date"][:4] if m["release_date"] else "N/A"}, рейтинг {m["vote_average"]}/10)' 
+                    movies_list = ", ".join([f'"{m.title}" ({m.year or "N/A"}, рейтинг {m.vote_average}/10)' 
                                            for m in popular_movies])
-                    enhanced_query += f"\n\nПопулярные {genre}ы из TMDB: {movies_list}"
+                    query_parts.append(f"Популярные {genre}ы из TMDB: {movies_list}")
             
-            if enhanced_query != user_query:
+            if len(query_parts) > 1:
                 logger.info("Query enhanced with TMDB data")
-                return enhanced_query
+                return "\n\n".join(query_parts)
             else:
                 logger.info("No additional TMDB data found for query")
                 return user_query
@@ -1671,7 +2157,9 @@ class RecommendationEngine:
             logger.error(f"Error enriching query with TMDB data: {e}")
             return user_query
 
-    def _normalize_person_name(self, name: str) -> str:
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _normalize_person_name(name: str) -> str:
         """
         Normalize person name from different Russian cases to nominative case.
         
@@ -1682,40 +2170,12 @@ class RecommendationEngine:
             Normalized name in nominative case
         """
         try:
-            # Базовая нормализация русских имен и фамилий
-            name_mapping = {
-                # Популярные актеры (из косвенных падежей в именительный)
-                'томом хэнксом': 'Том Хэнкс',
-                'тома хэнкса': 'Том Хэнкс',
-                'стивена спилберга': 'Стивен Спилберг',
-                'стивеном спилбергом': 'Стивен Спилберг',
-                'роберта дауни': 'Роберт Дауни',
-                'робертом дауни': 'Роберт Дауни',
-                'кристофера нолана': 'Кристофер Нолан',
-                'кристофером ноланом': 'Кристофер Нолан',
-                'леонардо дикаприо': 'Леонардо ДиКаприо',
-                'леонардом дикаприо': 'Леонардо ДиКаприо',
-                'брэда питта': 'Брэд Питт',
-                'брэдом питтом': 'Брэд Питт',
-                'джонни деппа': 'Джонни Депп',
-                'джонни деппом': 'Джонни Депп',
-                'уилла смита': 'Уилл Смит',
-                'уиллом смитом': 'Уилл Смит',
-                'квентина тарантино': 'Квентин Тарантино',
-                'квентином тарантино': 'Квентин Тарантино',
-                'мартина скорсезе': 'Мартин Скорсезе',
-                'мартином скорсезе': 'Мартин Скорсезе',
-                'скарлетт йоханссон': 'Скарлетт Йоханссон',
-                'скарлетт йоханссон': 'Скарлетт Йоханссон',
-                'анджелины джоли': 'Анджелина Джоли',
-                'анджелиной джоли': 'Анджелина Джоли',
-            }
             
             name_lower = name.lower().strip()
             
             # Проверяем прямое соответствие
-            if name_lower in name_mapping:
-                return name_mapping[name_lower]
+            if name_lower in _PERSON_NAME_MAPPING:
+                return _PERSON_NAME_MAPPING[name_lower]
             
             # Базовая обработка окончаний для неизвестных имен
             words = name.split()